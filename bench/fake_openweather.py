@@ -0,0 +1,177 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import unittest
+import zlib
+
+# local stand-in for the OpenWeather weather and forecast endpoints, for load testing without touching the real API
+# it replays the recorded payloads in bench/fixtures for every city, after an artificial latency, and can be made to fail
+# the payloads' times are moved to the current day when answering, so that observations look as recent as real ones do
+#   python3 -m bench.fake_openweather --latency 80 --error-rate 0.01 --not-found-rate 0.05
+#   export WAPI_API_BASE_URL=http://127.0.0.1:9099/data/2.5
+# GET /stats answers with the number of calls made to each endpoint so far
+
+DEFAULT_PORT = 9099
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+BASE_PATH = "/data/2.5"
+ENDPOINTS = ("weather", "forecast")
+STATS_PATH = "/stats"
+
+DAY_SECONDS = 24 * 60 * 60
+
+# class holding the fake's configuration, payloads and call counts, shared by every request handler thread
+# Attributes
+#   payloads: dictionary of endpoint names to the recorded response bodies, as parsed JSON
+#   recorded_at: unix time of the recorded weather observation
+#   latency: mean number of seconds waited before answering
+#   jitter: max number of seconds randomly added to or removed from latency
+#   error_rate: fraction of requests answered with a 500
+#   not_found_rate: fraction of cities answered with a 404. The same cities always are, on both endpoints
+#   calls: dictionary of endpoint names to the number of requests they got
+class FakeOpenWeather:
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, not_found_rate=0, fixtures_dir=FIXTURES_DIR):
+        self.payloads = {}
+        for endpoint in ENDPOINTS:
+            with open(os.path.join(fixtures_dir, "{}.json".format(endpoint)), encoding="utf-8") as f:
+                self.payloads[endpoint] = json.load(f)
+        self.recorded_at = self.payloads["weather"]["dt"]
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.not_found_rate = not_found_rate
+        self.calls = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.lock = threading.Lock()
+
+    # decides how to answer a request to one of the endpoints
+    # Parameters
+    #   endpoint: one of ENDPOINTS
+    #   query: dictionary with the query string arguments, as given by parse_qs
+    # Output
+    #   tuple of the HTTP status and the body of the response
+    def answer(self, endpoint, query):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if not query.get("appid"):
+            return 401, b'{"cod":401,"message":"Invalid API key."}'
+        if random.random() < self.error_rate:
+            return 500, b'{"cod":500,"message":"Internal error"}'
+        location = query.get("q", [""])[0].lower()
+        if zlib.crc32(location.encode("utf-8")) % 10000 < self.not_found_rate * 10000:
+            return 404, b'{"cod":"404","message":"city not found"}'
+        return 200, self.render(endpoint, time.time())
+
+    # Parameters
+    #   endpoint: one of ENDPOINTS
+    #   now: unix time the payload is answered at
+    # Output
+    #   the recorded payload as compact JSON bytes, like OpenWeather answers with. The weather observation is made at
+    #   {now}, and every other time is moved by whole days, keeping the times of day of the sun and the forecast steps
+    def render(self, endpoint, now):
+        offset = (int(now) - self.recorded_at) // DAY_SECONDS * DAY_SECONDS
+        payload = self.payloads[endpoint]
+        if endpoint == "weather":
+            payload = dict(payload, dt=int(now), sys=shift_sun(payload["sys"], offset))
+        else:
+            payload = dict(payload, city=shift_sun(payload["city"], offset), list=[
+                dict(item, dt=item["dt"] + offset, dt_txt=time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(item["dt"] + offset)))
+                for item in payload["list"]
+            ])
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+    def stats(self):
+        with self.lock:
+            return json.dumps(self.calls).encode("utf-8")
+
+# Output
+#   copy of a payload's dictionary with its sunrise and sunset moved by {offset} seconds
+def shift_sun(values, offset):
+    return dict(values, sunrise=values["sunrise"] + offset, sunset=values["sunset"] + offset)
+
+# builds the request handler class serving a FakeOpenWeather
+def make_handler(fake):
+
+    class FakeOpenWeatherHandler(BaseHTTPRequestHandler):
+
+        # keeping connections alive, like the real API does
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == STATS_PATH:
+                self.respond(200, fake.stats())
+                return
+
+            endpoint = url.path[len(BASE_PATH) + 1:] if url.path.startswith(BASE_PATH + "/") else None
+            if endpoint not in ENDPOINTS:
+                self.respond(404, b'{"cod":"404","message":"Not found"}')
+                return
+
+            self.respond(*fake.answer(endpoint, parse_qs(url.query)))
+
+        def respond(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeOpenWeatherHandler
+
+# Output
+#   the server, already serving on a daemon thread. For using the fake from other python code
+def start_server(fake, port=DEFAULT_PORT, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenWeather weather and forecast endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0, help="mean latency of each response, in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="max random deviation from the latency, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with a 500")
+    parser.add_argument("--not-found-rate", type=float, default=0, help="fraction of cities answered with a 404")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help="directory with the weather.json and forecast.json payloads to replay")
+    args = parser.parse_args()
+
+    fake = FakeOpenWeather(args.latency / 1000, args.jitter / 1000, args.error_rate, args.not_found_rate, args.fixtures)
+    server = start_server(fake, args.port, args.host)
+    print("Fake OpenWeather listening on http://{}:{}{}".format(args.host, args.port, BASE_PATH))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+# UNITTESTS
+
+class TestFakeOpenWeather(unittest.TestCase):
+    def test_payloads_are_moved_to_now(self):
+        fake = FakeOpenWeather()
+        now = fake.recorded_at + 3 * DAY_SECONDS + 60
+        weather = json.loads(fake.render("weather", now))
+        forecast = json.loads(fake.render("forecast", now))
+        self.assertEqual(weather["dt"], now)
+        self.assertEqual(weather["sys"]["sunrise"], fake.payloads["weather"]["sys"]["sunrise"] + 3 * DAY_SECONDS)
+        self.assertEqual(forecast["list"][0]["dt"], fake.payloads["forecast"]["list"][0]["dt"] + 3 * DAY_SECONDS)
+        self.assertEqual(forecast["list"][0]["dt_txt"], time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(forecast["list"][0]["dt"])))
+        self.assertEqual(len(forecast["list"]), len(fake.payloads["forecast"]["list"]))
+
+if __name__ == '__main__':
+    main()
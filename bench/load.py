@@ -0,0 +1,283 @@
+from http.client import HTTPConnection
+from urllib.parse import urlparse, urlencode
+import argparse
+import itertools
+import json
+import random
+import string
+import threading
+import time
+import unittest
+
+# load generator for the /weather route, meant to be run against a server using the fake OpenWeather (see fake_openweather.py)
+#   python3 -m bench.load --requests 5000 --concurrency 32 --miss-ratio 0.1 --skew 1.1 --output results.json
+#   python3 -m bench.load --requests 5000 --concurrency 32 --miss-ratio 0.1 --skew 1.1 --baseline results.json
+# requests either go to a set of hot cities, requested once before measuring so that they're cached, or to cities
+# never requested before, which always miss the cache. Hot cities are chosen following a zipf distribution of exponent {skew}
+# note that hot cities expire from the server's cache after 120 seconds, so longer runs will see more misses than asked for
+
+DEFAULT_TARGET = "http://127.0.0.1:8081"
+DEFAULT_UPSTREAM = "http://127.0.0.1:9099"
+PATH = "/weather"
+UPSTREAM_STATS_PATH = "/stats"
+COUNTRY = "uy"
+REQUEST_TIMEOUT_SECONDS = 60
+
+# Output
+#   an alphabetical name for the i-th city, so that it passes the server's validation. E.g 0 -> "a", 27 -> "bb"
+def city_name(i):
+    letters = []
+    while True:
+        letters.append(string.ascii_lowercase[i % 26])
+        i //= 26
+        if i == 0:
+            return "".join(reversed(letters))
+
+# Output
+#   cumulative weights of a zipf distribution over {count} ranks, for random.choices
+def zipf_cumulative_weights(count, skew):
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+# Output
+#   the value at the given percentile (0 to 100) of a sorted list, by nearest rank
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+# class responsible for choosing which city each request goes to
+# Attributes
+#   hot_cities: cities requested before measuring, so that they're cached
+#   cumulative_weights: zipf weights of the hot cities, the first being the most requested
+#   miss_ratio: fraction of requests going to cities never requested before
+#   run_id: letters prefixed to never requested cities, so that they miss the cache on every run
+class CityChooser:
+
+    def __init__(self, hot_keys, miss_ratio, skew):
+        self.hot_cities = ["hot {}".format(city_name(i)) for i in range(hot_keys)]
+        self.cumulative_weights = zipf_cumulative_weights(hot_keys, skew)
+        self.miss_ratio = miss_ratio
+        self.run_id = "".join(random.choice(string.ascii_lowercase) for _ in range(8))
+        self.misses = itertools.count()
+        self.lock = threading.Lock()
+
+    def choose(self, rng):
+        if not self.hot_cities or rng.random() < self.miss_ratio:
+            with self.lock:
+                miss = next(self.misses)
+            return "miss {} {}".format(self.run_id, city_name(miss))
+        return rng.choices(self.hot_cities, cum_weights=self.cumulative_weights)[0]
+
+# class responsible for sending requests from several threads and collecting their results
+# Attributes
+#   latencies: seconds taken by each request
+#   statuses: dictionary of HTTP status codes to the number of responses with them
+#   errors: number of requests that failed without a response (connection errors, timeouts)
+class LoadGenerator:
+
+    def __init__(self, target, chooser, concurrency, requests=None, duration=None, seed=None):
+        url = urlparse(target)
+        self.host = url.hostname
+        self.port = url.port
+        self.chooser = chooser
+        self.concurrency = concurrency
+        self.requests = requests
+        self.duration = duration
+        self.seed = seed
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.sent = itertools.count()
+        self.lock = threading.Lock()
+
+    # requests every hot city once, unmeasured
+    def warm_up(self):
+        connection = HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT_SECONDS)
+        for city in self.chooser.hot_cities:
+            self.__request(connection, city)
+        connection.close()
+
+    # Output
+    #   number of seconds the run took
+    def run(self):
+        self.deadline = None if self.duration is None else time.perf_counter() + self.duration
+        threads = [threading.Thread(target=self.__work, args=(i,)) for i in range(self.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    # PRIVATE METHODS
+
+    def __work(self, index):
+        rng = random.Random(None if self.seed is None else self.seed + index)
+        connection = HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT_SECONDS)
+        latencies = []
+        while self.__should_continue():
+            city = self.chooser.choose(rng)
+            started = time.perf_counter()
+            try:
+                status = self.__request(connection, city)
+            except Exception:
+                connection.close()
+                connection = HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT_SECONDS)
+                with self.lock:
+                    self.errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            with self.lock:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+        connection.close()
+        with self.lock:
+            self.latencies.extend(latencies)
+
+    def __should_continue(self):
+        if self.deadline is not None:
+            return time.perf_counter() < self.deadline
+        return next(self.sent) < self.requests
+
+    def __request(self, connection, city):
+        connection.request("GET", "{}?{}".format(PATH, urlencode({"city": city, "country": COUNTRY})))
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+# Output
+#   dictionary of the fake OpenWeather's endpoints to the number of calls they got, None if it couldn't be reached
+def upstream_calls(upstream):
+    url = urlparse(upstream)
+    try:
+        connection = HTTPConnection(url.hostname, url.port, timeout=REQUEST_TIMEOUT_SECONDS)
+        connection.request("GET", UPSTREAM_STATS_PATH)
+        calls = json.loads(connection.getresponse().read())
+        connection.close()
+        return calls
+    except Exception:
+        return None
+
+# puts the results of a run together
+def build_report(config, generator, elapsed, calls_before, calls_after):
+    latencies = sorted(generator.latencies)
+    report = {
+        "config": config,
+        "requests": len(latencies),
+        "errors": generator.errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(percentile(latencies, 100) * 1000, 2),
+        },
+        "statuses": {str(status): count for status, count in sorted(generator.statuses.items())},
+        "upstream_calls": None,
+    }
+    if calls_before is not None and calls_after is not None:
+        report["upstream_calls"] = {endpoint: calls_after[endpoint] - calls_before.get(endpoint, 0) for endpoint in calls_after}
+    return report
+
+# Output
+#   list of (name, value) of the numbers worth comparing between runs
+def report_metrics(report):
+    metrics = [
+        ("throughput (req/s)", report["throughput"]),
+        ("p50 (ms)", report["latency_ms"]["p50"]),
+        ("p95 (ms)", report["latency_ms"]["p95"]),
+        ("p99 (ms)", report["latency_ms"]["p99"]),
+        ("max (ms)", report["latency_ms"]["max"]),
+        ("errors", report["errors"]),
+    ]
+    if report["upstream_calls"] is not None:
+        metrics.extend(("upstream {} calls".format(endpoint), count) for endpoint, count in report["upstream_calls"].items())
+    return metrics
+
+def print_report(report, baseline=None):
+    print("{} requests in {}s, statuses: {}".format(report["requests"], report["seconds"], report["statuses"]))
+    baseline_metrics = dict(report_metrics(baseline)) if baseline is not None else {}
+    for name, value in report_metrics(report):
+        line = "  {:<24}{:>12}".format(name, value)
+        if name in baseline_metrics:
+            previous = baseline_metrics[name]
+            change = "" if not previous else " ({:+.1f}%)".format((value - previous) / previous * 100)
+            line += "   baseline {:>12}{}".format(previous, change)
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the /weather route")
+    parser.add_argument("--target", default=DEFAULT_TARGET, help="base url of the server under test")
+    parser.add_argument("--upstream", default=DEFAULT_UPSTREAM, help="base url of the fake OpenWeather, for counting upstream calls")
+    parser.add_argument("--requests", type=int, default=1000, help="number of measured requests")
+    parser.add_argument("--duration", type=float, help="run for this many seconds instead of a number of requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of requests in flight at once")
+    parser.add_argument("--hot-keys", type=int, default=100, help="number of cached cities")
+    parser.add_argument("--miss-ratio", type=float, default=0.1, help="fraction of requests to never requested cities")
+    parser.add_argument("--skew", type=float, default=1.0, help="zipf exponent of the hot cities' popularity, 0 for uniform")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="file to save the report to, as JSON")
+    parser.add_argument("--baseline", help="report file of a previous run to compare against")
+    args = parser.parse_args()
+
+    config = {
+        "target": args.target,
+        "requests": args.requests if args.duration is None else None,
+        "duration": args.duration,
+        "concurrency": args.concurrency,
+        "hot_keys": args.hot_keys,
+        "miss_ratio": args.miss_ratio,
+        "skew": args.skew,
+    }
+
+    chooser = CityChooser(args.hot_keys, args.miss_ratio, args.skew)
+    generator = LoadGenerator(args.target, chooser, args.concurrency, args.requests, args.duration, args.seed)
+    print("Warming up {} hot cities...".format(args.hot_keys))
+    generator.warm_up()
+
+    print("Running...")
+    calls_before = upstream_calls(args.upstream)
+    elapsed = generator.run()
+    calls_after = upstream_calls(args.upstream)
+    report = build_report(config, generator, elapsed, calls_before, calls_after)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+# UNITTESTS
+
+class TestLoad(unittest.TestCase):
+    def test_city_name(self):
+        self.assertEqual([city_name(i) for i in (0, 25, 26, 27, 701, 702)], ["a", "z", "ba", "bb", "baz", "bba"])
+
+    def test_city_names_are_unique(self):
+        self.assertEqual(len({city_name(i) for i in range(10000)}), 10000)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([], 50), 0)
+
+    def test_zipf_weights(self):
+        self.assertEqual(zipf_cumulative_weights(3, 0), [1, 2, 3])
+        self.assertEqual(zipf_cumulative_weights(3, 1), [1, 1.5, 1 + 1 / 2 + 1 / 3])
+
+    def test_chooser_misses(self):
+        chooser = CityChooser(hot_keys=10, miss_ratio=1, skew=1)
+        rng = random.Random(0)
+        cities = [chooser.choose(rng) for _ in range(100)]
+        self.assertEqual(len(set(cities)), 100)
+        self.assertTrue(all(city.startswith("miss ") for city in cities))
+
+if __name__ == '__main__':
+    main()
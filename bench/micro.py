@@ -0,0 +1,184 @@
+from src import codec
+from src.client import WeatherClient
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+import unittest
+from unittest.mock import patch
+
+# microbenchmarks of the CPU work done per request, over the recorded payloads in bench/fixtures
+#   python3 -m bench.micro --output micro.json
+#   python3 -m bench.micro --baseline micro.json --threshold 20
+#   python3 -m bench.micro --codec orjson --baseline micro.json
+#   python3 -m bench.micro --compare-codecs
+# every stage is timed as the best of {repeat} rounds, in microseconds per call
+# with --baseline, exits with 1 if any stage got slower than the baseline by more than {threshold} percent. Baselines
+# are only comparable on the same machine
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD_PERCENT = 20
+# slowdowns smaller than this are timer noise on the sub-microsecond stages, whatever their percent
+MIN_REGRESSION_MICROSECONDS = 1
+REQUESTED_TIME = "27-10-2021 13:55:23"
+
+# reads a fixture as the compact JSON bytes OpenWeather would send
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, "{}.json".format(name)), encoding="utf-8") as f:
+        return json.dumps(json.load(f), separators=(",", ":")).encode("utf-8")
+
+# builds a client the way the application does, keeping its history away from the working directory
+# the environment is only changed while building it
+def make_client(history_dir):
+    environ = {'WAPI_HISTORY_DIR': history_dir}
+    if 'WAPI_API_KEY' not in os.environ:
+        environ['WAPI_API_KEY'] = "bench"
+    with patch.dict(os.environ, environ):
+        return WeatherClient()
+
+# Output
+#   dictionary of stage names to functions running them once, all going through the same code as a request does
+def build_stages(client):
+    weather_payload = load_fixture("weather")
+    forecast_payload = load_fixture("forecast")
+    weather = client._handle_response(200, weather_payload)
+    forecast = client._handle_response(200, forecast_payload)
+    current = client.parser.parse_weather(weather)
+    parsed_forecast = client.parser.parse_forecast(forecast)
+    weather_json = client._build_weather_json("uy", "Punta del Este", REQUESTED_TIME, current, parsed_forecast)
+    client.cache.store(("punta del este", "uy"), weather_json)
+
+    # cache hits of hot locations are served from the rendered JSON, others are decompressed
+    def cache_hit_cold():
+        client.cache.rendered.clear()
+        return client.cache.get(("punta del este", "uy"))
+
+    # everything a cache miss does, but the requests themselves
+    def miss_pipeline():
+        client._validate_parameters("uy", "Punta del Este")
+        current = client.parser.parse_weather(client._handle_response(200, weather_payload))
+        parsed_forecast = client.parser.parse_forecast(client._handle_response(200, forecast_payload))
+        return client._build_weather_json("uy", "Punta del Este", REQUESTED_TIME, current, parsed_forecast)
+
+    return {
+        "validate_city": lambda: WeatherClient.validate_city("Punta del Este"),
+        "validate_country": lambda: WeatherClient.validate_country("uy"),
+        "decode_weather": lambda: client._handle_response(200, weather_payload),
+        "decode_forecast": lambda: client._handle_response(200, forecast_payload),
+        "parse_weather": lambda: client.parser.parse_weather(weather),
+        "parse_forecast": lambda: client.parser.parse_forecast(forecast),
+        "encode_response": lambda: client._build_weather_json("uy", "Punta del Este", REQUESTED_TIME, current, parsed_forecast),
+        "cache_hit": lambda: client.cache.get(("punta del este", "uy")),
+        "cache_hit_cold": cache_hit_cold,
+        "cache_store": lambda: client.cache.store(("punta del este", "uy"), weather_json),
+        "miss_pipeline": miss_pipeline,
+    }
+
+# Output
+#   dictionary of stage names to microseconds per call
+def run_stages(stages, repeat):
+    results = {}
+    for name, stage in stages.items():
+        timer = timeit.Timer(stage)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=repeat, number=number))
+        results[name] = round(best / number * 1e6, 3)
+    return results
+
+# Parameters
+#   results, baseline: dictionaries of stage names to microseconds per call
+#   threshold: max percent a stage may get slower than its baseline
+# Output
+#   list of (stage, baseline, result, percent change) of the stages over the threshold
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        change = (result - previous) / previous * 100
+        if change > threshold and result - previous >= MIN_REGRESSION_MICROSECONDS:
+            regressions.append((name, previous, result, change))
+    return regressions
+
+def print_results(results, baseline=None):
+    for name, result in results.items():
+        line = "  {:<20}{:>12.3f} us".format(name, result)
+        if baseline is not None and baseline.get(name):
+            line += "   baseline {:>12.3f} us ({:+.1f}%)".format(baseline[name], (result - baseline[name]) / baseline[name] * 100)
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the per-request CPU work")
+    parser.add_argument("--codec", choices=list(codec.CODECS), help="JSON codec to use, defaulted to WAPI_JSON_CODEC's")
+    parser.add_argument("--compare-codecs", action="store_true", help="run the suite with every installed codec")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--output", help="file to save the results to, as JSON")
+    parser.add_argument("--baseline", help="results file of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD_PERCENT, help="percent slowdown over the baseline that fails the run")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+
+    with tempfile.TemporaryDirectory() as history_dir:
+        client = make_client(history_dir)
+
+        if args.compare_codecs:
+            runs = {}
+            for name in codec.available_codecs():
+                codec.set_codec(name)
+                runs[name] = run_stages(build_stages(client), args.repeat)
+            names = list(runs)
+            print("  {:<20}".format("stage") + "".join("{:>15}".format(name + " (us)") for name in names))
+            for stage in runs[names[0]]:
+                print("  {:<20}".format(stage) + "".join("{:>15.3f}".format(runs[name][stage]) for name in names))
+            return
+
+        if args.codec is not None:
+            codec.set_codec(args.codec)
+        print("Running stages with the {} codec...".format(codec.codec.name))
+        results = run_stages(build_stages(client), args.repeat)
+
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"codec": codec.codec.name, "stages": results}, f, indent=4)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, previous, result, change in regressions:
+            print("Regression: {} went from {:.3f} us to {:.3f} us ({:+.1f}%, threshold {}%)".format(name, previous, result, change, args.threshold))
+        if regressions:
+            sys.exit(1)
+
+# UNITTESTS
+
+class TestMicro(unittest.TestCase):
+    def test_find_regressions(self):
+        baseline = {"parse_weather": 10, "parse_forecast": 100, "validate_city": 0.5, "removed_stage": 5}
+        results = {"parse_weather": 12.5, "parse_forecast": 110, "validate_city": 1, "new_stage": 1}
+        self.assertEqual(find_regressions(results, baseline, 20), [("parse_weather", 10, 12.5, 25)])
+        self.assertEqual(find_regressions(results, baseline, 30), [])
+
+    def test_make_client_leaves_environment_unchanged(self):
+        environ = dict(os.environ)
+        with tempfile.TemporaryDirectory() as history_dir:
+            client = make_client(history_dir)
+        self.assertEqual(client.history.directory, history_dir)
+        self.assertEqual(dict(os.environ), environ)
+
+    def test_stages_match_a_real_response(self):
+        with tempfile.TemporaryDirectory() as history_dir:
+            stages = build_stages(make_client(history_dir))
+            self.assertEqual(stages["miss_pipeline"](), stages["encode_response"]())
+            self.assertEqual(stages["cache_hit_cold"](), stages["encode_response"]())
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,13 @@
-from flask import Flask
-from src.handler import weather_handler
+from src.app import create_app
+from src.client import create_history_store
 import os
 
 DEFAULT_PORT = 8081
 
 def main():
 
-    app = Flask(__name__)
-    app.register_blueprint(weather_handler)
+    create_history_store().compact()
+    app = create_app()
 
     # setting port...
     port=os.environ.get('WAPI_PORT')
@@ -0,0 +1,84 @@
+from gunicorn.app.base import BaseApplication
+from src.app import create_app
+from src.handler import init_weather_client
+from src.config import get_int_env, DEFAULT_THREADS
+from src.client import get_upstream_limits, create_history_store
+from src.logger import log, OK as LOG_OK, WARNING as LOG_WARNING, ERROR as LOG_ERROR
+import multiprocessing
+import gc
+import os
+import sys
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8081
+DEFAULT_GRACEFUL_TIMEOUT_SECONDS = 30
+
+# one worker per core, so throughput scales with the machine the service runs on
+DEFAULT_WORKERS = multiprocessing.cpu_count()
+
+# gunicorn hook, runs on each worker right after it's forked from the master process
+def post_fork(server, worker):
+    # the client owns a connection pool and a cache, neither of which should be shared between processes
+    init_weather_client()
+    log(LOG_OK, "Worker {} ready".format(worker.pid))
+
+# gunicorn application serving this API with several pre-forked, multi-threaded workers
+# the flask app is loaded once on the master process before forking (preload_app), so the imported modules and the
+# app with its routes are shared between workers copy-on-write. The weather client (parser, cache, limiter, session)
+# is created on each worker after forking, see post_fork
+# on SIGTERM/SIGINT workers stop accepting connections and drain in-flight requests for up to graceful_timeout seconds
+class WeatherServer(BaseApplication):
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        app = create_app(init_client=False)
+
+        # dropping observations past the retention period once here, rather than on every worker
+        create_history_store().compact()
+
+        # moving everything allocated so far out of the gc's reach, so that collections on the workers don't
+        # touch (and therefore copy) the pages shared with the master process
+        gc.freeze()
+
+        return app
+
+def main():
+
+    # failing here rather than on each worker, which would otherwise keep being respawned by the master
+    if os.environ.get('WAPI_API_KEY') is None:
+        log(LOG_ERROR, "Application initialized without an api key. Please set the WAPI_API_KEY environment to a valid OpenWeather appid")
+        sys.exit()
+
+    host = os.environ.get('WAPI_HOST')
+    if host is None:
+        host = DEFAULT_HOST
+
+    # requests waiting for the external API hold a thread, so if they can take all of them cache hits queue up behind them
+    threads = get_int_env('WAPI_THREADS', DEFAULT_THREADS)
+    max_concurrency, max_queue = get_upstream_limits(threads)
+    if max_concurrency + max_queue >= threads:
+        log(LOG_WARNING, "WAPI_UPSTREAM_CONCURRENCY + WAPI_UPSTREAM_QUEUE ({}) should be lower than WAPI_THREADS ({}), \
+otherwise requests to the external API can take every thread and block cache hits".format(max_concurrency + max_queue, threads))
+
+    options = {
+        "bind": "{}:{}".format(host, get_int_env('WAPI_PORT', DEFAULT_PORT)),
+        "workers": get_int_env('WAPI_WORKERS', DEFAULT_WORKERS),
+        "threads": threads,
+        "worker_class": "gthread",
+        "graceful_timeout": get_int_env('WAPI_GRACEFUL_TIMEOUT', DEFAULT_GRACEFUL_TIMEOUT_SECONDS),
+        "preload_app": True,
+        "post_fork": post_fork,
+    }
+
+    log(LOG_OK, "Starting server on {} with {} workers of {} threads each".format(options["bind"], options["workers"], options["threads"]))
+    WeatherServer(options).run()
+
+if __name__ == '__main__':
+    main()
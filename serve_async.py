@@ -0,0 +1,35 @@
+import uvicorn
+from src.config import get_int_env
+from src.logger import log, OK as LOG_OK, ERROR as LOG_ERROR
+import os
+import sys
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8081
+DEFAULT_GRACEFUL_TIMEOUT_SECONDS = 30
+
+# serves the ASGI app on a single process, with every request to the external API made asynchronously
+# on SIGTERM/SIGINT the server stops accepting connections and drains in-flight requests for up to graceful_timeout seconds
+def main():
+
+    if os.environ.get('WAPI_API_KEY') is None:
+        log(LOG_ERROR, "Application initialized without an api key. Please set the WAPI_API_KEY environment to a valid OpenWeather appid")
+        sys.exit()
+
+    host = os.environ.get('WAPI_HOST')
+    if host is None:
+        host = DEFAULT_HOST
+    port = get_int_env('WAPI_PORT', DEFAULT_PORT)
+
+    log(LOG_OK, "Starting async server on {}:{}".format(host, port))
+    uvicorn.run(
+        "src.asgi:app",
+        host=host,
+        port=port,
+        lifespan="on",
+        access_log=False,
+        timeout_graceful_shutdown=get_int_env('WAPI_GRACEFUL_TIMEOUT', DEFAULT_GRACEFUL_TIMEOUT_SECONDS),
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+from flask import Flask
+from unittest.mock import patch
+import os
+import tempfile
+import unittest
+from . import handler
+from .handler import weather_handler, init_weather_client, PATH
+
+# builds the flask application serving this API
+# Parameters
+#   init_client: if True, the weather client is created right away. Forking servers should pass False and
+#       call init_weather_client on each worker after forking instead
+# Output
+#   Flask application with every handler registered
+def create_app(init_client=True):
+
+    app = Flask(__name__)
+    app.register_blueprint(weather_handler)
+
+    if init_client:
+        init_weather_client()
+
+    return app
+
+# UNITTESTS
+
+class TestApp(unittest.TestCase):
+    def setUp(self):
+        history = tempfile.TemporaryDirectory()
+        self.addCleanup(history.cleanup)
+        self.enterContext(patch.dict(os.environ, {'WAPI_API_KEY': "test", 'WAPI_HISTORY_DIR': history.name}))
+        self.enterContext(patch.object(handler, "weather_client", None))
+
+    def test_deferred_client(self):
+        app = create_app(init_client=False)
+        self.assertIn(PATH, [rule.rule for rule in app.url_map.iter_rules()])
+        self.assertIsNone(handler.weather_client)
+
+        init_weather_client()
+        self.assertIsNotNone(handler.weather_client)
+
+    def test_client_created_by_default(self):
+        create_app()
+        self.assertIsNotNone(handler.weather_client)
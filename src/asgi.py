@@ -0,0 +1,222 @@
+from urllib.parse import parse_qs
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from . import handler
+from .app import create_app
+from .async_client import AsyncWeatherClient, FakeAsyncSession, fake_upstream, UNKNOWN_CITY
+from .client import WeatherClient
+from .handler import error_response, PATH, HISTORY_PATH, OK, BAD_REQUEST, SERVICE_UNAVAILABLE
+from .logger import log, OK as LOG_OK
+
+NOT_FOUND = 404
+METHOD_NOT_ALLOWED = 405
+
+JSON_HEADERS = [(b"content-type", b"application/json")]
+TEXT_HEADERS = [(b"content-type", b"text/plain; charset=utf-8")]
+
+# client used by the app, created on lifespan startup as its session needs the server's event loop
+weather_client = None
+
+# ASGI application serving the /weather routes with the async client
+# its responses are byte-for-byte the same as the flask handler's, see handler.py
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    route = ROUTES.get(scope["path"])
+    if route is None:
+        await respond(send, NOT_FOUND, TEXT_HEADERS, b"Not Found")
+        return
+    if scope["method"] not in ("GET", "HEAD"):
+        await respond(send, METHOD_NOT_ALLOWED, TEXT_HEADERS, b"Method Not Allowed")
+        return
+
+    args = parse_qs(scope["query_string"], keep_blank_values=True)
+    status, content, headers = await route(args)
+
+    body = content.encode("utf-8")
+    length = len(body)
+    if scope["method"] == "HEAD":
+        body = b""
+    extra_headers = [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    await respond(send, status, JSON_HEADERS + extra_headers, body, length)
+
+# ROUTES
+# each takes the parsed query string and returns a tuple of the HTTP status, the JSON string content and a dictionary of extra headers
+
+async def get_weather(args):
+    city = get_arg(args, b"city")
+    country = get_arg(args, b"country")
+    log(LOG_OK, "Recieved weather request for {}, {}".format(city, country))
+
+    try:
+        return OK, await weather_client.get_weather(country, city), {}
+    except Exception as e:
+        return error_response(e, country, city)
+
+async def get_history(args):
+    city = get_arg(args, b"city")
+    country = get_arg(args, b"country")
+    start = get_arg(args, b"from")
+    end = get_arg(args, b"to")
+    log(LOG_OK, "Recieved history request for {}, {}".format(city, country))
+
+    try:
+        # history is read from disk, off the event loop
+        return OK, await asyncio.to_thread(weather_client.get_history, country, city, start, end), {}
+    except Exception as e:
+        return error_response(e, country, city)
+
+ROUTES = {
+    PATH: get_weather,
+    HISTORY_PATH: get_history,
+}
+
+# handles the ASGI lifespan protocol, creating the client and compacting its history on startup and closing its session on shutdown
+async def lifespan(receive, send):
+    global weather_client
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            weather_client = AsyncWeatherClient()
+            await weather_client.start()
+            await asyncio.to_thread(weather_client.history.compact)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await weather_client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+# Output
+#   first value of a query string argument decoded as a string, or None if it's missing (same as flask's request.args.get)
+def get_arg(args, name):
+    values = args.get(name)
+    if not values:
+        return None
+    return values[0].decode("utf-8", "replace")
+
+async def respond(send, status, headers, body, length=None):
+    if length is None:
+        length = len(body)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers + [(b"content-length", str(length).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+# UNITTESTS
+
+# stand-in for the requests session, answering like FakeAsyncSession does
+class FakeSession:
+    def get(self, url, params, timeout):
+        status, content = fake_upstream(url, params)
+        return SimpleNamespace(status_code=status, content=content)
+
+# both clients stamp responses with the time they were requested at
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2021, 10, 27, 13, 55, 23)
+
+# stores weather that's already expired, as the last known weather of a location
+def store_stale(cache, key, weather_json):
+    ttl = cache.ttl
+    cache.ttl = 0
+    cache.store(key, weather_json)
+    cache.ttl = ttl
+
+class TestAsgi(unittest.IsolatedAsyncioTestCase):
+    STALE_JSON = '{"location_name": "Salto, UY", "temperature": "88 \\u00b0F, 31 \\u00b0C", "forecast": []}'
+
+    # tuples of the method, path and query string of a request, whether the external API's only slot is taken while
+    # making it, and the status both apps answer it with
+    REQUESTS = [
+        ("GET", PATH, "city=Montevideo&country=uy", False, OK),
+        ("HEAD", PATH, "city=Montevideo&country=uy", False, OK),
+        ("GET", PATH, "city=Montevideo&country=UY", False, BAD_REQUEST),
+        ("GET", PATH, "country=uy", False, BAD_REQUEST),
+        ("GET", PATH, "city={}&country=uy".format(UNKNOWN_CITY), False, NOT_FOUND),
+        ("GET", HISTORY_PATH, "city=Montevideo&country=uy&from=0", False, OK),
+        ("GET", HISTORY_PATH, "city=Montevideo&country=uy&from=yesterday", False, BAD_REQUEST),
+        # cached, served without a slot
+        ("GET", PATH, "city=Montevideo&country=uy", True, OK),
+        # rejected, with and without stale weather to fall back on
+        ("GET", PATH, "city=Salto&country=uy", True, OK),
+        ("HEAD", PATH, "city=Salto&country=uy", True, OK),
+        ("GET", PATH, "city=Rivera&country=uy", True, SERVICE_UNAVAILABLE),
+        ("HEAD", PATH, "city=Rivera&country=uy", True, SERVICE_UNAVAILABLE),
+    ]
+
+    async def asyncSetUp(self):
+        history = tempfile.TemporaryDirectory()
+        self.addCleanup(history.cleanup)
+        # keeping the fake's observations, made in 2021, for the history routes to answer with
+        self.enterContext(patch.dict(os.environ, {
+            'WAPI_API_KEY': "test",
+            'WAPI_HISTORY_DIR': history.name,
+            'WAPI_HISTORY_RETENTION': str(100 * 365 * 24 * 60 * 60),
+            'WAPI_UPSTREAM_CONCURRENCY': "1",
+            'WAPI_UPSTREAM_QUEUE': "0",
+        }))
+        self.enterContext(patch("src.client.datetime", FixedDatetime))
+        self.enterContext(patch("src.async_client.datetime", FixedDatetime))
+
+        self.sync_client = WeatherClient()
+        self.sync_client.session = FakeSession()
+        store_stale(self.sync_client.cache, ("salto", "uy"), self.STALE_JSON)
+        self.flask_client = create_app(init_client=False).test_client()
+        self.enterContext(patch.object(handler, "weather_client", self.sync_client))
+
+        self.async_client = AsyncWeatherClient()
+        self.async_client.session = FakeAsyncSession()
+        store_stale(self.async_client.cache, ("salto", "uy"), self.STALE_JSON)
+        self.addAsyncCleanup(self.async_client.close)
+        self.enterContext(patch.object(sys.modules[__name__], "weather_client", self.async_client))
+
+    # Output
+    #   tuple of the status, the headers and the body the app answers a request with
+    async def request(self, method, path, query):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": query.encode("utf-8")}
+        await app(scope, receive, send)
+        start, body = messages
+        return start["status"], dict(start["headers"]), body["body"]
+
+    async def test_responses_match_flask(self):
+        for method, path, query, overloaded, expected_status in self.REQUESTS:
+            with self.subTest(method=method, path=path, query=query, overloaded=overloaded):
+                if overloaded:
+                    sync_started = self.sync_client.limiter.acquire()
+                    async_started = await self.async_client.limiter.acquire()
+                try:
+                    expected = self.flask_client.open("{}?{}".format(path, query), method=method)
+                    status, headers, body = await self.request(method, path, query)
+                finally:
+                    if overloaded:
+                        self.sync_client.limiter.release(sync_started)
+                        self.async_client.limiter.release(async_started)
+                self.assertEqual(expected.status_code, expected_status)
+                self.assertEqual(status, expected.status_code)
+                self.assertEqual(body, expected.data)
+                self.assertEqual(headers, {name.lower().encode(): value.encode() for name, value in expected.headers.items()})
+
+    async def test_unknown_route(self):
+        status, _, body = await self.request("GET", "/nowhere", "")
+        self.assertEqual((status, body), (NOT_FOUND, b"Not Found"))
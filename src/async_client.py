@@ -0,0 +1,348 @@
+import aiohttp
+import asyncio
+from .logger import log, OK as LOG_OK
+from .client import WeatherClient, CityNotFound, WEATHER_EXTERNAL_ENDPOINT, FORECAST_EXTERNAL_ENDPOINT
+from .limiter import AsyncUpstreamLimiter, Rejected
+from .config import get_int_env
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import patch
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+# max number of simultaneous connections to the external API
+DEFAULT_UPSTREAM_CONNECTIONS = 256
+# requests waiting for the external API don't hold threads here, so many more can be queued than on the sync client
+DEFAULT_ASYNC_UPSTREAM_QUEUE = 4096
+# threads appending observations to history. Each location's file has its own lock, so different locations are written at once
+HISTORY_WRITER_THREADS = 4
+
+# asyncio version of WeatherClient, for serving many concurrent requests from a single thread
+# validation, caching, parsing and the format of the response are the same as WeatherClient's, only the requests
+# to the external API differ: they're made concurrently (weather and forecast at the same time) over a pooled aiohttp session
+# Attributes (on top of WeatherClient's)
+#   session: aiohttp session, created by start() as it needs a running event loop
+#   in_flight: dictionary of cache keys to the tasks fetching them, so that concurrent misses for the same
+#       location share a single round of requests to the external API instead of each making their own
+#   history_writer: threads observations are appended to history on, in the background, so responses don't wait on disk
+class AsyncWeatherClient(WeatherClient):
+
+    # PUBLIC METHODS
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = {}
+        self.history_writer = ThreadPoolExecutor(max_workers=HISTORY_WRITER_THREADS, thread_name_prefix="history-writer")
+
+    # opens the session used for requests to the external API. Must be called from within the event loop before getting weather
+    async def start(self):
+        connections = get_int_env('WAPI_UPSTREAM_CONNECTIONS', DEFAULT_UPSTREAM_CONNECTIONS)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=connections),
+            timeout=aiohttp.ClientTimeout(total=self.upstream_timeout)
+        )
+
+    # closes the session and waits for pending history appends to be written
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        await asyncio.to_thread(self.history_writer.shutdown)
+
+    # same as WeatherClient.get_weather, but awaitable
+    async def get_weather(self, country, city):
+
+        # validating parameters...
+        city_country = self._validate_parameters(country, city)
+
+        # checking cache...
+        cached = self._get_cached(city_country)
+        if cached is not None:
+
+            log(LOG_OK, "Weather data for {}, {} was found on cache, retrieving...".format(city, country))
+            return cached
+
+        # joining a fetch already running for this location, if any...
+        task = self.in_flight.get(city_country)
+        if task is None:
+            task = asyncio.ensure_future(self.__fetch_weather(country, city))
+            self.in_flight[city_country] = task
+            task.add_done_callback(lambda done: self.__forget(city_country, done))
+
+        # shielded so that a client disconnecting doesn't cancel the fetch for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    # PROTECTED METHODS
+
+    # the aiohttp session can only be created inside the event loop, see start()
+    def _create_session(self):
+        return None
+
+    # sized after the connection pool rather than threads: each fetch takes two connections (weather and forecast at once)
+    def _create_limiter(self, timeout):
+        connections = get_int_env('WAPI_UPSTREAM_CONNECTIONS', DEFAULT_UPSTREAM_CONNECTIONS)
+        return AsyncUpstreamLimiter(
+            get_int_env('WAPI_UPSTREAM_CONCURRENCY', max(1, connections // 2)),
+            get_int_env('WAPI_UPSTREAM_QUEUE', DEFAULT_ASYNC_UPSTREAM_QUEUE, minimum=0),
+            timeout
+        )
+
+    # PRIVATE METHODS
+
+    # done callback of fetch tasks, removes them from in_flight
+    def __forget(self, city_country, task):
+        self.in_flight.pop(city_country, None)
+        # marking the exception as retrieved, every waiter may have gone away before it was raised
+        if not task.cancelled():
+            task.exception()
+
+    # gets weather and forecast from the external API and stores them in the cache
+    # Output
+    #   the weather JSON string sent as response
+    async def __fetch_weather(self, country, city):
+
+        # waiting for our turn to use the external api...
+        # done inside the task so that requests joining it while it waits don't take slots of their own
+        try:
+            started = await self.limiter.acquire()
+        except Rejected as e:
+            raise self._overloaded((city.lower(), country), e.retry_after)
+
+        # running get weather logic... (external api)
+        try:
+            requested_time = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+            requests = (
+                asyncio.ensure_future(self.__get_current_weather(country, city)),
+                asyncio.ensure_future(self.__get_forecast(country, city))
+            )
+            try:
+                current, forecast = await asyncio.gather(*requests)
+            except BaseException:
+                # gather leaves the other request running when one fails, and it must not keep using a connection
+                # once the slot is released
+                for request in requests:
+                    request.cancel()
+                await asyncio.gather(*requests, return_exceptions=True)
+                raise
+        finally:
+            self.limiter.release(started)
+
+        # putting stuff together...
+        weather_json = self._build_weather_json(country, city, requested_time, current, forecast)
+
+        # store in cache...
+        self._store((city.lower(), country), weather_json)
+
+        return weather_json
+
+    async def __get_current_weather(self, country_code, city):
+
+        # making request to external api...
+        params = self._build_params(country_code, city)
+        log(LOG_OK, "Making current weather request to external API for {}, {}".format(city, country_code))
+        unparsed_result = await self.__make_request(params, WEATHER_EXTERNAL_ENDPOINT)
+        # appending takes a file lock and writes to disk, so it's left to the background writer
+        self.history_writer.submit(self._record_observation, country_code, city, unparsed_result)
+
+        # parsing response...
+        return self.parser.parse_weather(unparsed_result)
+
+    async def __get_forecast(self, country_code, city):
+
+        # making request to external api...
+        params = self._build_params(country_code, city)
+        log(LOG_OK, "Making forecast request to external API for {}, {}".format(city, country_code))
+        unparsed_result = await self.__make_request(params, FORECAST_EXTERNAL_ENDPOINT)
+
+        # parsing response...
+        return self.parser.parse_forecast(unparsed_result)
+
+    # makes the actual request to the OpenWeather API and handles response
+    # Parameters
+    #   endpoint: A string. Should take the value of either WEATHER_EXTERNAL_ENDPOINT or FORECAST_EXTERNAL_ENDPOINT
+    async def __make_request(self, params, endpoint):
+        # validation...
+        if endpoint not in (WEATHER_EXTERNAL_ENDPOINT, FORECAST_EXTERNAL_ENDPOINT):
+            raise ValueError("trying to make a request to unsupported OpenWeather endpoint '{}'".format(endpoint))
+
+        # make request...
+        url = "{}/{}".format(self.url, endpoint)
+        async with self.session.get(url, params=params) as response:
+            content = await response.read()
+
+            # handling response...
+            return self._handle_response(response.status, content)
+
+# UNITTESTS
+
+# OpenWeather responses answered by the fake sessions, keyed by endpoint
+UPSTREAM_RESPONSES = {
+    WEATHER_EXTERNAL_ENDPOINT: json.dumps({
+        "coord": {"lon": -56.1674, "lat": -34.8335},
+        "weather": [{"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}],
+        "main": {"temp": 302.21, "pressure": 1020, "humidity": 29},
+        "wind": {"speed": 1.54, "deg": 180},
+        "dt": 1635369297,
+        "sys": {"country": "UY", "sunrise": 1635324147, "sunset": 1635372277},
+        "name": "Montevideo",
+        "cod": 200
+    }, separators=(",", ":")).encode("utf-8"),
+    FORECAST_EXTERNAL_ENDPOINT: json.dumps({
+        "cod": "200",
+        "list": [{
+            "dt": 1635379200,
+            "main": {"temp": 288.4, "pressure": 1008, "humidity": 75},
+            "weather": [{"id": 803, "main": "Clouds", "description": "broken clouds", "icon": "04n"}],
+            "wind": {"speed": 6.86, "deg": 185},
+            "dt_txt": "2021-10-28 00:00:00"
+        }]
+    }, separators=(",", ":")).encode("utf-8"),
+}
+# cities the fake sessions answer with a 404
+UNKNOWN_CITY = "Nowhere"
+
+# Output
+#   tuple of the HTTP status and the body OpenWeather would answer a request with
+def fake_upstream(url, params):
+    if params["q"].startswith(UNKNOWN_CITY + ","):
+        return 404, b'{"cod":"404","message":"city not found"}'
+    return 200, UPSTREAM_RESPONSES[url.rsplit("/", 1)[1]]
+
+# stand-in for the aiohttp session, answering with fake_upstream unless the endpoint's responses are held
+# Attributes
+#   releases: dictionary of endpoints to the events their responses wait for
+#   calls: number of requests made to each endpoint
+#   pending: number of requests waiting for their response
+class FakeAsyncSession:
+
+    def __init__(self):
+        self.releases = {endpoint: asyncio.Event() for endpoint in UPSTREAM_RESPONSES}
+        self.let_through()
+        self.calls = {endpoint: 0 for endpoint in UPSTREAM_RESPONSES}
+        self.pending = 0
+
+    # holds the responses of the given endpoints, or of every endpoint if none is given, until let_through is called
+    def hold(self, *endpoints):
+        for endpoint in endpoints or self.releases:
+            self.releases[endpoint].clear()
+
+    def let_through(self):
+        for release in self.releases.values():
+            release.set()
+
+    def get(self, url, params):
+        endpoint = url.rsplit("/", 1)[1]
+        self.calls[endpoint] += 1
+        return FakeAsyncResponse(self, self.releases[endpoint], *fake_upstream(url, params))
+
+    async def close(self):
+        pass
+
+class FakeAsyncResponse:
+
+    def __init__(self, session, release, status, content):
+        self.session = session
+        self.release = release
+        self.status = status
+        self.content = content
+
+    async def __aenter__(self):
+        self.session.pending += 1
+        try:
+            await self.release.wait()
+        finally:
+            self.session.pending -= 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.content
+
+class TestAsyncWeatherClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        history = tempfile.TemporaryDirectory()
+        self.addCleanup(history.cleanup)
+        environ = patch.dict(os.environ, {'WAPI_API_KEY': "test", 'WAPI_HISTORY_DIR': history.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        self.client = AsyncWeatherClient()
+        self.session = self.client.session = FakeAsyncSession()
+        self.addAsyncCleanup(self.client.close)
+
+    async def wait_for_fetch(self):
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def test_concurrent_misses_share_a_fetch(self):
+        self.session.hold()
+        requests = [asyncio.ensure_future(self.client.get_weather("uy", "Montevideo")) for _ in range(5)]
+        await self.wait_for_fetch()
+        self.assertEqual(list(self.client.in_flight), [("montevideo", "uy")])
+
+        self.session.let_through()
+        responses = await asyncio.gather(*requests)
+        self.assertEqual(len(set(responses)), 1)
+        self.assertEqual(self.session.calls, {WEATHER_EXTERNAL_ENDPOINT: 1, FORECAST_EXTERNAL_ENDPOINT: 1})
+        self.assertEqual(self.client.in_flight, {})
+
+        # later requests are cache hits
+        self.assertEqual(await self.client.get_weather("uy", "Montevideo"), responses[0])
+        self.assertEqual(self.session.calls, {WEATHER_EXTERNAL_ENDPOINT: 1, FORECAST_EXTERNAL_ENDPOINT: 1})
+
+    async def test_cancelled_request_doesnt_cancel_the_fetch(self):
+        self.session.hold()
+        cancelled = asyncio.ensure_future(self.client.get_weather("uy", "Montevideo"))
+        waiting = asyncio.ensure_future(self.client.get_weather("uy", "Montevideo"))
+        await self.wait_for_fetch()
+        cancelled.cancel()
+        await self.wait_for_fetch()
+        self.assertEqual(len(self.client.in_flight), 1)
+
+        self.session.let_through()
+        response = await waiting
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        self.assertEqual(self.client.cache.get(("montevideo", "uy")), response)
+
+    async def test_failed_fetch_is_forgotten(self):
+        self.session.hold()
+        requests = [asyncio.ensure_future(self.client.get_weather("uy", UNKNOWN_CITY)) for _ in range(2)]
+        await self.wait_for_fetch()
+        self.session.let_through()
+        for result in await asyncio.gather(*requests, return_exceptions=True):
+            self.assertIsInstance(result, CityNotFound)
+        self.assertEqual(self.client.in_flight, {})
+
+        # not cached, so the next request fetches again
+        with self.assertRaises(CityNotFound):
+            await self.client.get_weather("uy", UNKNOWN_CITY)
+        self.assertEqual(self.session.calls[WEATHER_EXTERNAL_ENDPOINT], 2)
+
+    async def test_response_doesnt_wait_for_history(self):
+        release = threading.Event()
+        written = []
+
+        def append(key, weather):
+            release.wait(1)
+            written.append(key)
+
+        self.client.history.append = append
+        await asyncio.wait_for(self.client.get_weather("uy", "Montevideo"), 0.5)
+        self.assertEqual(written, [])
+
+        release.set()
+        await self.client.close()
+        self.assertEqual(written, [("montevideo", "uy")])
+
+    async def test_failed_request_cancels_the_other(self):
+        self.session.hold(FORECAST_EXTERNAL_ENDPOINT)
+        with self.assertRaises(CityNotFound):
+            await asyncio.wait_for(self.client.get_weather("uy", UNKNOWN_CITY), 1)
+        self.assertEqual(self.session.pending, 0)
+        self.assertEqual(self.client.limiter.active, 0)
@@ -0,0 +1,167 @@
+from cachetools import LRUCache
+import itertools
+import threading
+import sys
+import time
+import zlib
+import unittest
+
+# rough number of bytes taken by each cache entry on top of its value: key tuple, dictionary slot and LRU bookkeeping
+ENTRY_OVERHEAD_BYTES = 256
+
+# compact cache record for a weather JSON string
+# the JSON of a forecast repeats the same keys and formats dozens of times, so it's kept zlib-compressed,
+# which takes about a tenth of the memory of the string itself
+# Attributes
+#   packed: the weather JSON string, utf-8 encoded and compressed
+#   expires: time.monotonic() value after which the record is stale
+#   version: number telling this record apart from others stored for the same location
+class CompactWeather:
+
+    __slots__ = ("packed", "expires", "version")
+
+    def __init__(self, weather_json, ttl=0, version=0):
+        self.packed = zlib.compress(weather_json.encode("utf-8"))
+        self.expires = time.monotonic() + ttl
+        self.version = version
+
+    def is_fresh(self):
+        return time.monotonic() < self.expires
+
+    # Output
+    #   the weather JSON string, exactly as it was stored
+    def render(self):
+        return zlib.decompress(self.packed).decode("utf-8")
+
+    # Output
+    #   number of bytes this record takes in a cache, used for eviction
+    def size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.packed) + sys.getsizeof(self.expires) + sys.getsizeof(self.version) + ENTRY_OVERHEAD_BYTES
+
+# Parameters
+#   item: tuple of a record's version and its JSON string, as kept in WeatherCache.rendered
+# Output
+#   number of bytes the item takes in a cache
+def rendered_size(item):
+    return sys.getsizeof(item) + sys.getsizeof(item[0]) + sys.getsizeof(item[1]) + ENTRY_OVERHEAD_BYTES
+
+# class responsible for keeping weather JSON strings in memory, bounded by a number of bytes rather than of entries
+# it takes up to {max_bytes} + {rendered_max_bytes} bytes in total
+# it's thread safe, as it's shared by every thread of a worker
+# Attributes
+#   ttl: number of seconds records are valid for
+#   records: record of each location, valid for {ttl} seconds after being stored and kept past that as the location's
+#       last known weather, used when it can't be fetched because of overload. The least recently used ones, whether
+#       valid or not, are evicted when over {max_bytes}
+#   rendered: JSON strings of the most recently read records, so that hot locations aren't decompressed on every hit.
+#       evicted when over {rendered_max_bytes}
+#       the values are tuples of the record's version and its JSON string, the JSON is only used if the record in records
+#       still has that version. Records aren't referenced from here, so evicted ones are freed
+#   versions: counter numbering stored records
+class WeatherCache:
+
+    def __init__(self, max_bytes, ttl, rendered_max_bytes):
+        self.ttl = ttl
+        self.versions = itertools.count(1)
+        self.records = LRUCache(maxsize=max_bytes, getsizeof=CompactWeather.size)
+        self.rendered = LRUCache(maxsize=rendered_max_bytes, getsizeof=rendered_size)
+        self.lock = threading.Lock()
+
+    # Parameters
+    #   key: tuple of the city in lowercase and the country code. E.g ("bogota", "co")
+    # Output
+    #   the weather JSON string for the location, or None if there's no valid one
+    def get(self, key):
+        with self.lock:
+            record = self.records.get(key)
+            if record is None or not record.is_fresh():
+                return None
+            item = self.rendered.get(key)
+            if item is not None and item[0] == record.version:
+                return item[1]
+
+        weather_json = record.render()
+        with self.lock:
+            self.__remember(key, record, weather_json)
+        return weather_json
+
+    # Output
+    #   the last known weather JSON string for the location even if it expired, or None if there's none
+    def get_stale(self, key):
+        with self.lock:
+            record = self.records.get(key)
+        if record is None:
+            return None
+        return record.render()
+
+    def store(self, key, weather_json):
+        record = CompactWeather(weather_json, self.ttl, next(self.versions))
+        with self.lock:
+            # too big records are just not cached, rather than raising
+            if record.size() <= self.records.maxsize:
+                self.records[key] = record
+            self.__remember(key, record, weather_json)
+
+    def __remember(self, key, record, weather_json):
+        item = (record.version, weather_json)
+        if rendered_size(item) <= self.rendered.maxsize:
+            self.rendered[key] = item
+
+# UNITTESTS
+
+class TestWeatherCache(unittest.TestCase):
+    WEATHER_JSON = '{"location_name": "Montevideo, UY", "temperature": "88 \\u00b0F, 31 \\u00b0C", "forecast": []}'
+
+    def test_record_renders_stored_json(self):
+        record = CompactWeather(self.WEATHER_JSON)
+        self.assertEqual(record.render(), self.WEATHER_JSON)
+
+    def test_record_is_smaller_than_forecast_json(self):
+        forecast_json = '{"forecast": [' + ", ".join(['{"temperature": "59 \\u00b0F, 15 \\u00b0C", "humidity": "75%"}'] * 40) + ']}'
+        self.assertLess(CompactWeather(forecast_json).size(), sys.getsizeof(forecast_json))
+
+    def test_get(self):
+        cache = WeatherCache(max_bytes=10000, ttl=60, rendered_max_bytes=0)
+        cache.store(("montevideo", "uy"), self.WEATHER_JSON)
+        self.assertEqual(cache.get(("montevideo", "uy")), self.WEATHER_JSON)
+        self.assertIsNone(cache.get(("santiago", "cl")))
+
+    def test_evicts_by_bytes(self):
+        size = CompactWeather(self.WEATHER_JSON).size()
+        cache = WeatherCache(max_bytes=size * 2, ttl=60, rendered_max_bytes=0)
+        cache.store(("montevideo", "uy"), self.WEATHER_JSON)
+        cache.store(("santiago", "cl"), self.WEATHER_JSON)
+        cache.get(("montevideo", "uy"))
+        cache.store(("lima", "pe"), self.WEATHER_JSON)
+        self.assertEqual(set(cache.records), {("montevideo", "uy"), ("lima", "pe")})
+
+    def test_stale_outlives_ttl(self):
+        cache = WeatherCache(max_bytes=10000, ttl=0, rendered_max_bytes=10000)
+        cache.store(("montevideo", "uy"), self.WEATHER_JSON)
+        self.assertIsNone(cache.get(("montevideo", "uy")))
+        self.assertEqual(cache.get_stale(("montevideo", "uy")), self.WEATHER_JSON)
+
+    def test_rendered_is_sized_in_bytes(self):
+        weather_json = self.WEATHER_JSON.replace("\\u00b0", "°")
+        item = (1, weather_json)
+        self.assertGreater(rendered_size(item), len(weather_json.encode("utf-8")))
+        cache = WeatherCache(max_bytes=10000, ttl=60, rendered_max_bytes=rendered_size(item) - 1)
+        cache.store(("montevideo", "uy"), weather_json)
+        self.assertEqual(len(cache.rendered), 0)
+
+    def test_rendered_doesnt_keep_records(self):
+        size = CompactWeather(self.WEATHER_JSON).size()
+        cache = WeatherCache(max_bytes=size, ttl=60, rendered_max_bytes=10000)
+        cache.store(("montevideo", "uy"), self.WEATHER_JSON)
+        cache.store(("santiago", "cl"), self.WEATHER_JSON)
+        self.assertEqual(list(cache.records), [("santiago", "cl")])
+        self.assertFalse(any(isinstance(value, CompactWeather) for item in cache.rendered.values() for value in item))
+        self.assertIsNone(cache.get(("montevideo", "uy")))
+
+    def test_rendered_of_replaced_record_isnt_used(self):
+        longer_json = self.WEATHER_JSON.replace("[]", "[{}]" * 100)
+        cache = WeatherCache(max_bytes=10000, ttl=60, rendered_max_bytes=rendered_size((1, self.WEATHER_JSON)))
+        cache.store(("montevideo", "uy"), self.WEATHER_JSON)
+        # too long to be rendered, so the previous JSON is left in rendered
+        cache.store(("montevideo", "uy"), longer_json)
+        self.assertEqual(cache.get(("montevideo", "uy")), longer_json)
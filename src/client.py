@@ -1,12 +1,19 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from . import codec
 from .logger import log, WARNING as LOG_WARNING, OK as LOG_OK, ERROR as LOG_ERROR
 from .parser import OpenWeatherParser
 from datetime import datetime
-from cachetools import TTLCache
+import time
+from .limiter import UpstreamLimiter, Rejected
+from .config import get_int_env, DEFAULT_THREADS
+from .cache import WeatherCache
+from .history import HistoryStore, unpack_observation
 import os
 import sys
+import tempfile
 import unittest
+from unittest.mock import patch
 
 EXTERNAL_API_BASE_URL = "https://api.openweathermap.org/data/2.5"
 
@@ -14,7 +21,25 @@ WEATHER_EXTERNAL_ENDPOINT = "weather"
 FORECAST_EXTERNAL_ENDPOINT = "forecast"
 
 CACHE_STORAGE_TIME_SECONDS = 120
-CACHE_MAXSIZE = 100
+
+# memory budgets of the cache (per process)
+# weather of each location, valid or expired. Expired weather is served when the external API can't take more requests
+DEFAULT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# JSON strings of hot locations, kept so that they aren't decompressed on every hit
+DEFAULT_RENDERED_CACHE_MAX_BYTES = 1024 * 1024
+
+# every observation fetched from the external API is kept on disk for history queries
+DEFAULT_HISTORY_DIR = "history"
+DEFAULT_HISTORY_RETENTION_SECONDS = 7 * 24 * 60 * 60
+# range of history queries that don't specify a start
+DEFAULT_HISTORY_RANGE_SECONDS = 24 * 60 * 60
+
+# admission control for requests to the external API (per process)
+# requests waiting for the external API hold a thread, so by default fetching and waiting only take up to three quarters
+# of a worker's threads, leaving the rest for cache hits. See get_upstream_limits
+DEFAULT_UPSTREAM_QUEUE_TIMEOUT_SECONDS = 5
+# max number of seconds a request to the external API may take, so a hung one doesn't hold its slot forever
+DEFAULT_UPSTREAM_TIMEOUT_SECONDS = 10
 
 # class responsible for fetching weather data from external api or cache
 # also responsible for updating the cache after external api requests
@@ -23,13 +48,13 @@ CACHE_MAXSIZE = 100
 #   api_key: token necessary for accessing external API
 #   parser: object responsible for parsing external API responses
 #   cache: data structure used for saving external API data in order to avoid unnecessarily making the same request more than once
-#       the cache functions as a python dictionary that uses string tuples of size 2 as keys. 
+#       the cache maps string tuples of size 2 to the weather data ready to be sent as response.
 #       the first element of each tuple key is the city in lowercase, the second element is the country code.
-#       the values of the dictionary are JSON strings with the weather data ready to be sent as response
-#       each value of the dictionary expires after {CACHE_STORAGE_TIME_SECONDS} seconds after insertion
-#       E.g of cache data structure:
+#       each value expires after {CACHE_STORAGE_TIME_SECONDS} seconds after insertion, values are kept compressed and evicted
+#       once they take more than WAPI_CACHE_BYTES, plus WAPI_RENDERED_CACHE_BYTES for the JSON of hot locations, see cache.py
+#       E.g of cache data (decompressed):
 #       {
-#           ("Montevideo", "uy"): "{
+#           ("montevideo", "uy"): "{
 #               "location_name": "Montevideo, UY",
 #               "temperature": "88 °F, 31 °C",
 #               "pressure": "1020 hpa",
@@ -41,16 +66,23 @@ CACHE_MAXSIZE = 100
 #               "requested_time": "27-10-2021 13:55:23",
 #               "forecast": [...]
 #           }",
-#           ("Buenos Aires", "ar"): "{ ... }",
-#           ("Santiago", "cl"): "{ ... }"   
+#           ("buenos aires", "ar"): "{ ... }",
+#           ("santiago", "cl"): "{ ... }"   
 #       }
+#       expired values are kept, within the same budget, as the last known weather of their location
+#   history: on-disk store of every current weather observation fetched from the external API, see history.py
+#   limiter: bounds the number of concurrent requests to the external API. Cache hits never go through it
+#   session: requests session used for pooling connections to the external API. It shouldn't be shared across processes,
+#       so a client should be created on each worker after forking
 class WeatherClient:
 
     # PUBLIC METHODS
 
     def __init__(self):
 
-        self.url = EXTERNAL_API_BASE_URL
+        self.url = os.environ.get('WAPI_API_BASE_URL')
+        if self.url is None:
+            self.url = EXTERNAL_API_BASE_URL
 
         self.api_key = os.environ.get('WAPI_API_KEY')
         if self.api_key is None:
@@ -72,7 +104,18 @@ class WeatherClient:
                     .format(repr(e)))
                 self.parser = OpenWeatherParser()
 
-        self.cache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_STORAGE_TIME_SECONDS)
+        self.cache = WeatherCache(
+            get_int_env('WAPI_CACHE_BYTES', DEFAULT_CACHE_MAX_BYTES),
+            CACHE_STORAGE_TIME_SECONDS,
+            get_int_env('WAPI_RENDERED_CACHE_BYTES', DEFAULT_RENDERED_CACHE_MAX_BYTES)
+        )
+
+        self.history = create_history_store()
+
+        self.upstream_timeout = get_int_env('WAPI_UPSTREAM_TIMEOUT', DEFAULT_UPSTREAM_TIMEOUT_SECONDS)
+        self.limiter = self._create_limiter(get_int_env('WAPI_UPSTREAM_QUEUE_TIMEOUT', DEFAULT_UPSTREAM_QUEUE_TIMEOUT_SECONDS))
+
+        self.session = self._create_session()
     
     # gets weather and forecast for a location defined by a country code and a city name.
     # validates the country and city parameters to be of the expected format
@@ -81,6 +124,8 @@ class WeatherClient:
     #   country: string expected to be of size 2 and lowercase. E.g "co" 
     #   city: string. E.g "Bogota" 
 
+    # raises Overloaded if too many requests to the external API are already running or waiting
+
     # Output
     #     dictionanary with weather data
     #     {
@@ -94,42 +139,167 @@ class WeatherClient:
     def get_weather(self, country, city):
 
         # validating parameters...
-        errors = []
-        city_errors = WeatherClient.validate_city(city)
-        country_errors = WeatherClient.validate_country(country)
-        errors.extend(city_errors)
-        errors.extend(country_errors)
-        if len(errors) > 0:
-            raise InvalidParameters(errors)
+        city_country = self._validate_parameters(country, city)
 
-        city_country = (city.lower(), country)
         # checking cache...
-        if city_country in self.cache:
+        cached = self._get_cached(city_country)
+        if cached is not None:
 
             log(LOG_OK, "Weather data for {}, {} was found on cache, retrieving...".format(city, country))
-            return self.cache[city_country]
+            return cached
 
         else: 
             
+            # waiting for our turn to use the external api...
+            try:
+                started = self.limiter.acquire()
+            except Rejected as e:
+                raise self._overloaded(city_country, e.retry_after)
+
             # running get weather logic... (external api)
-            requested_time = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-            result = {
-                "location_name": "{}, {}".format(city.capitalize(), country.upper())
-            }
-            current = self.__get_current_weather(country, city)
-            forecast = self.__get_forecast(country, city)
+            try:
+                requested_time = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+                current = self.__get_current_weather(country, city)
+                forecast = self.__get_forecast(country, city)
+            finally:
+                self.limiter.release(started)
 
             # putting stuff together...
-            result.update(current)
-            result['requested_time'] = requested_time
-            result['forecast'] = forecast
-            weather_json = json.dumps(result)
+            weather_json = self._build_weather_json(country, city, requested_time, current, forecast)
 
             # store in cache...
-            self.cache[city_country] = weather_json
+            self._store(city_country, weather_json)
 
             return weather_json
 
+    # gets the observations stored for a location within a time range, without using the external API
+    # validates the parameters the same way get_weather does
+
+    # Parameters
+    #   country: string expected to be of size 2 and lowercase. E.g "co" 
+    #   city: string. E.g "Bogota" 
+    #   start: unix time string, defaulted to {DEFAULT_HISTORY_RANGE_SECONDS} before end. E.g "1635369297"
+    #   end: unix time string, defaulted to now
+
+    # Output
+    #     JSON string with the observations in the same format as forecast items, oldest first
+    #     {
+    #        "location_name": "Montevideo, UY",
+    #        "history": [{...}]
+    #     }
+    def get_history(self, country, city, start=None, end=None):
+
+        # validating parameters...
+        errors = []
+        errors.extend(WeatherClient.validate_timestamp(start, "from"))
+        errors.extend(WeatherClient.validate_timestamp(end, "to"))
+        try:
+            city_country = self._validate_parameters(country, city)
+        except InvalidParameters as e:
+            errors = e.errors + errors
+        if len(errors) > 0:
+            raise InvalidParameters(errors)
+
+        end = int(time.time()) if end is None else int(end)
+        start = end - DEFAULT_HISTORY_RANGE_SECONDS if start is None else int(start)
+
+        # reading and parsing observations...
+        observations = self.history.query(city_country, start, end)
+        history = self.parser.parse_forecast({
+            "list": [unpack_observation(observation) for observation in observations]
+        })
+
+        return codec.dumps({
+            "location_name": "{}, {}".format(city.capitalize(), country.upper()),
+            "history": history
+        })
+
+    # PROTECTED METHODS
+    # shared with the async client, which only differs from this one in how it talks to the external API
+
+    # creates the session used for requests to the external API
+    # requests are only made holding a limiter slot, one at a time, so its pool keeps a connection for each slot.
+    # With requests' default of 10, connections past that would be discarded and reopened exactly when under load
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.limiter.max_concurrency)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    # creates the limiter for requests to the external API, sized after the number of threads of the worker
+    def _create_limiter(self, timeout):
+        max_concurrency, max_queue = get_upstream_limits(get_int_env('WAPI_THREADS', DEFAULT_THREADS))
+        return UpstreamLimiter(max_concurrency, max_queue, timeout)
+
+    # validates the country and city parameters, raising InvalidParameters if any of them is invalid
+    # Output
+    #   the cache key for the location. E.g ("bogota", "co")
+    def _validate_parameters(self, country, city):
+        errors = []
+        city_errors = WeatherClient.validate_city(city)
+        country_errors = WeatherClient.validate_country(country)
+        errors.extend(city_errors)
+        errors.extend(country_errors)
+        if len(errors) > 0:
+            raise InvalidParameters(errors)
+        return (city.lower(), country)
+
+    # Output
+    #   the cached weather JSON string for the location, or None if it isn't cached
+    def _get_cached(self, city_country):
+        return self.cache.get(city_country)
+
+    def _store(self, city_country, weather_json):
+        self.cache.store(city_country, weather_json)
+
+    # builds the exception raised when the limiter rejects a request, carrying the last known weather for the location if any
+    def _overloaded(self, city_country, retry_after):
+        stale = self.cache.get_stale(city_country)
+        log(LOG_WARNING, "Too many requests to external API, rejecting request for {}, {}{}"
+            .format(city_country[0], city_country[1], "" if stale is None else " (serving stale data)"))
+        return Overloaded(retry_after, stale)
+
+    # saves an observation fetched from the external API to history
+    # failing to do so is logged, but doesn't fail the request
+    def _record_observation(self, country_code, city, weather):
+        try:
+            self.history.append((city.lower(), country_code), weather)
+        except Exception as e:
+            log(LOG_WARNING, "Couldn't save observation for {}, {} to history: {}".format(city, country_code, repr(e)))
+
+    # builds the query parameters for a request to the external API
+    def _build_params(self, country_code, city):
+        return {
+            "q": "{},{}".format(city, country_code),
+            "appid": self.api_key 
+        }
+
+    # puts the parsed weather and forecast together into the JSON string sent as response
+    def _build_weather_json(self, country, city, requested_time, current, forecast):
+        result = {
+            "location_name": "{}, {}".format(city.capitalize(), country.upper())
+        }
+        result.update(current)
+        result['requested_time'] = requested_time
+        result['forecast'] = forecast
+        return codec.dumps(result)
+
+    # handles a response from the external API
+    # Parameters
+    #   code: HTTP status code of the response
+    #   content: body of the response
+    # Output
+    #   the decoded body for OK responses, None for unexpected ones
+    def _handle_response(self, code, content):
+        if code == 200:
+            return codec.loads(content)
+        else:
+            if code == 401:
+                raise InvalidAPIKey
+            if code == 404:
+                raise CityNotFound
+
     # PRIVATE METHODS
 
     # uses an external api to get current weather for a location, returns dictionary
@@ -142,12 +312,10 @@ class WeatherClient:
     def __get_current_weather(self, country_code, city):
 
         # making request to external api...
-        params = {
-            "q": "{},{}".format(city, country_code),
-            "appid": self.api_key 
-        }
+        params = self._build_params(country_code, city)
         log(LOG_OK, "Making current weather request to external API for {}, {}".format(city, country_code))
         unparsed_result = self.__make_request(params, WEATHER_EXTERNAL_ENDPOINT)
+        self._record_observation(country_code, city, unparsed_result)
 
         # parsing response...
         result = self.parser.parse_weather(unparsed_result)
@@ -165,10 +333,7 @@ class WeatherClient:
     def __get_forecast(self, country_code, city):
 
         # making request to external api...
-        params = {
-            "q": "{},{}".format(city, country_code),
-            "appid": self.api_key 
-        }
+        params = self._build_params(country_code, city)
         log(LOG_OK, "Making forecast request to external API for {}, {}".format(city, country_code))
         unparsed_result = self.__make_request(params, FORECAST_EXTERNAL_ENDPOINT)
 
@@ -187,17 +352,10 @@ class WeatherClient:
 
         # make request...
         url = "{}/{}".format(self.url, endpoint)
-        response = requests.get(url, params)
+        response = self.session.get(url, params=params, timeout=self.upstream_timeout)
 
         # handling response...
-        code = response.status_code
-        if code == 200:
-            return json.loads(response.content)
-        else:
-            if code == 401:
-                raise InvalidAPIKey
-            if code == 404:
-                raise CityNotFound
+        return self._handle_response(response.status_code, response.content)
 
 
     # The validate methods could/should be private but I didn't find a way to apply unittests to private methods in python
@@ -229,6 +387,34 @@ class WeatherClient:
                 errors.append("invalid country: contains non-alphabetical values")
         return errors
 
+    # timestamps are optional, None is valid
+    def validate_timestamp(timestamp, name):
+        errors = []
+        if timestamp is not None:
+            # isdigit alone would let through characters such as "¹", which int can't parse
+            if not isinstance(timestamp, str) or not (timestamp.isascii() and timestamp.isdigit()):
+                errors.append("invalid {}: not a unix timestamp".format(name))
+        return errors
+
+# Parameters
+#   threads: number of threads serving requests on the process
+# Output
+#   tuple of the max number of concurrent and of queued requests to the external API, from WAPI_UPSTREAM_CONCURRENCY and
+#   WAPI_UPSTREAM_QUEUE or, when not set, half and a quarter of the threads
+def get_upstream_limits(threads):
+    max_concurrency = get_int_env('WAPI_UPSTREAM_CONCURRENCY', max(1, threads // 2))
+    max_queue = get_int_env('WAPI_UPSTREAM_QUEUE', threads // 4, minimum=0)
+    return max_concurrency, max_queue
+
+# Output
+#   the history store configured by WAPI_HISTORY_DIR and WAPI_HISTORY_RETENTION
+# stores are cheap to create, but compacting them walks every file, so servers should only do it once on startup
+def create_history_store():
+    history_dir = os.environ.get('WAPI_HISTORY_DIR')
+    if history_dir is None:
+        history_dir = DEFAULT_HISTORY_DIR
+    return HistoryStore(history_dir, get_int_env('WAPI_HISTORY_RETENTION', DEFAULT_HISTORY_RETENTION_SECONDS))
+
 # EXCEPTIONS
 # custom exceptions raised by this module
 
@@ -244,6 +430,13 @@ class CityNotFound(Exception):
     def __init__(self):
         pass
 
+class Overloaded(Exception):
+    def __init__(self, retry_after, stale=None):
+        # seconds after which the request is likely to succeed
+        self.retry_after = retry_after
+        # last known weather JSON string for the location, None if there's none
+        self.stale = stale
+
 # UNITTESTS
 
 class TestValidators(unittest.TestCase):
@@ -316,3 +509,41 @@ class TestValidators(unittest.TestCase):
         input = "a%"
         expected_output = ['invalid country: contains non-alphabetical values']
         self.assertEqual(WeatherClient.validate_country(input), expected_output)
+
+    def test_valid_timestamp(self):
+        input = "1635369297"
+        expected_output = []
+        self.assertEqual(WeatherClient.validate_timestamp(input, "from"), expected_output)
+
+    def test_valid_timestamp_missing(self):
+        input = None
+        expected_output = []
+        self.assertEqual(WeatherClient.validate_timestamp(input, "from"), expected_output)
+
+    def test_invalid_timestamp_negative(self):
+        input = "-1635369297"
+        expected_output = ['invalid to: not a unix timestamp']
+        self.assertEqual(WeatherClient.validate_timestamp(input, "to"), expected_output)
+
+    def test_invalid_timestamp_date(self):
+        input = "2021-10-27"
+        expected_output = ['invalid from: not a unix timestamp']
+        self.assertEqual(WeatherClient.validate_timestamp(input, "from"), expected_output)
+
+    def test_invalid_timestamp_superscript(self):
+        input = "¹"
+        expected_output = ['invalid from: not a unix timestamp']
+        self.assertEqual(WeatherClient.validate_timestamp(input, "from"), expected_output)
+
+    def test_invalid_timestamp_non_ascii_digits(self):
+        input = "١٦٣٥"
+        expected_output = ['invalid to: not a unix timestamp']
+        self.assertEqual(WeatherClient.validate_timestamp(input, "to"), expected_output)
+
+class TestWeatherClient(unittest.TestCase):
+    def test_connection_pool_fits_upstream_concurrency(self):
+        with tempfile.TemporaryDirectory() as history_dir:
+            with patch.dict(os.environ, {'WAPI_API_KEY': "test", 'WAPI_HISTORY_DIR': history_dir, 'WAPI_UPSTREAM_CONCURRENCY': "24"}):
+                client = WeatherClient()
+        for prefix in ("https://", "http://"):
+            self.assertEqual(client.session.get_adapter(prefix)._pool_maxsize, 24)
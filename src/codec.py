@@ -0,0 +1,93 @@
+from .logger import log, WARNING as LOG_WARNING
+import json
+import os
+import unittest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON encoding and decoding used across the application, so that a faster implementation can be swapped in
+# the codec is chosen with the WAPI_JSON_CODEC environment variable, or set_codec
+#   json: python's standard library (default)
+#   orjson: decodes OpenWeather responses several times faster. Encoded responses are compact and keep non-ascii
+#       characters unescaped (e.g "°" instead of "\u00b0"), so they're equivalent but not byte-identical to json's
+
+DEFAULT_CODEC = "json"
+
+class JsonCodec:
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+class OrjsonCodec:
+    name = "orjson"
+
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+}
+
+# Output
+#   names of the codecs that can be used, i.e. whose library is installed
+def available_codecs():
+    return [name for name in CODECS if name != OrjsonCodec.name or orjson is not None]
+
+# Parameters
+#   name: one of CODECS' keys. None for the default codec
+# Output
+#   the codec, or the default one if it's unknown or its library isn't installed
+def get_codec(name):
+    if name is None:
+        name = DEFAULT_CODEC
+    if name not in available_codecs():
+        log(LOG_WARNING, "JSON codec '{}' is unknown or not installed. Using {} instead...".format(name, DEFAULT_CODEC))
+        name = DEFAULT_CODEC
+    return CODECS[name]()
+
+# codec currently in use
+codec = None
+
+def set_codec(name):
+    global codec
+    codec = get_codec(name)
+
+# encodes an object as a JSON string with the codec in use
+def dumps(obj):
+    return codec.dumps(obj)
+
+# decodes a JSON string or bytes with the codec in use
+def loads(data):
+    return codec.loads(data)
+
+set_codec(os.environ.get('WAPI_JSON_CODEC'))
+
+# UNITTESTS
+
+class TestCodecs(unittest.TestCase):
+    WEATHER = {"location_name": "Montevideo, UY", "temperature": "88 °F, 31 °C", "forecast": [{"humidity": "29%"}]}
+
+    def test_json_matches_standard_library(self):
+        self.assertEqual(JsonCodec().dumps(self.WEATHER), json.dumps(self.WEATHER))
+
+    def test_round_trip(self):
+        for name in available_codecs():
+            codec = get_codec(name)
+            self.assertEqual(codec.loads(codec.dumps(self.WEATHER)), self.WEATHER)
+            self.assertEqual(codec.loads(json.dumps(self.WEATHER).encode("utf-8")), self.WEATHER)
+            self.assertIsInstance(codec.dumps(self.WEATHER), str)
+
+    def test_unknown_codec_falls_back_to_default(self):
+        self.assertEqual(get_codec("simdjson").name, DEFAULT_CODEC)
+        self.assertEqual(get_codec(None).name, DEFAULT_CODEC)
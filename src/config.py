@@ -0,0 +1,22 @@
+from .logger import log, WARNING as LOG_WARNING
+import os
+
+# number of threads serving requests on each worker of the production server
+DEFAULT_THREADS = 16
+
+# reads an integer environment variable, falling back to a default if it's missing or invalid
+# Parameters
+#   name: name of the environment variable. E.g "WAPI_WORKERS"
+#   default: value used when the variable isn't set or isn't an integer of at least {minimum}
+def get_int_env(name, default, minimum=1):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = minimum - 1
+    if value < minimum:
+        log(LOG_WARNING, "{} environment variable was set to an invalid value. Initializing with default value {}...".format(name, default))
+        return default
+    return value
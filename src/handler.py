@@ -1,17 +1,36 @@
-from flask import Blueprint, request, Response
-import json
-from .client import WeatherClient, InvalidParameters, InvalidAPIKey, CityNotFound
+from flask import Flask, Blueprint, request, Response
+from unittest.mock import patch
+import os
+import sys
+import tempfile
+import unittest
+from . import codec
+from .client import WeatherClient, InvalidParameters, InvalidAPIKey, CityNotFound, Overloaded
+from .limiter import UpstreamLimiter
 from .logger import log, OK as LOG_OK, ERROR as LOG_ERROR
 
 OK = 200
 BAD_REQUEST = 400
 INTERNAL_SERVER_ERROR = 500
 NOT_FOUND = 404
+SERVICE_UNAVAILABLE = 503
+
+# header flagging responses built from expired cache data (RFC 7234 warn-code 110)
+STALE_WARNING = '110 - "Response is Stale"'
 
 PATH = "/weather"
+HISTORY_PATH = "/weather/history"
 
 weather_handler = Blueprint("weather_handler", __name__)
-weather_client = WeatherClient()
+
+# the client is created by init_weather_client rather than at import time, so that a forking server can import
+# this module once on its master process and still give each worker its own client (and its own connection pool)
+weather_client = None
+
+# creates the client used by this process' handlers. Needs to be called once per process before serving requests
+def init_weather_client():
+    global weather_client
+    weather_client = WeatherClient()
 
 @weather_handler.route(PATH, methods=['GET'])
 def get_weather():
@@ -19,33 +38,123 @@ def get_weather():
     country = request.args.get("country")
     log(LOG_OK, "Recieved weather request for {}, {}".format(city, country))
 
+    headers = {}
     try:
         content = weather_client.get_weather(country, city)
         status = OK 
-    except InvalidParameters as e:
+    except Exception as e:
+        status, content, headers = error_response(e, country, city)
+
+    return Response(content, status, headers=headers, mimetype="application/json")
+
+@weather_handler.route(HISTORY_PATH, methods=['GET'])
+def get_history():
+    city = request.args.get("city")
+    country = request.args.get("country")
+    start = request.args.get("from")
+    end = request.args.get("to")
+    log(LOG_OK, "Recieved history request for {}, {}".format(city, country))
+
+    headers = {}
+    try:
+        content = weather_client.get_history(country, city, start, end)
+        status = OK 
+    except Exception as e:
+        status, content, headers = error_response(e, country, city)
+
+    return Response(content, status, headers=headers, mimetype="application/json")
+
+# maps an exception raised when getting weather to the response sent back to the user
+# shared with the ASGI app so that both serving paths answer exactly the same
+# Parameters
+#   e: exception raised by the weather client
+# Output
+#   tuple of the HTTP status, the JSON string content and a dictionary of extra headers of the response
+def error_response(e, country, city):
+    headers = {}
+    if isinstance(e, Overloaded):
+        if e.stale is not None:
+            status = OK
+            content = e.stale
+            headers["Warning"] = STALE_WARNING
+        else:
+            status = SERVICE_UNAVAILABLE
+            content = codec.dumps({
+                "message": "The service is too busy right now, please try again later"
+            })
+            headers["Retry-After"] = str(e.retry_after)
+    elif isinstance(e, InvalidParameters):
         status = BAD_REQUEST
-        content = json.dumps({
+        content = codec.dumps({
             "message": "Invalid parameters. Please make sure that the city and country are valid",
             "errors": e.errors
         })
-    except CityNotFound:
+    elif isinstance(e, CityNotFound):
         status = NOT_FOUND
-        content = json.dumps({
+        content = codec.dumps({
             "message": "The city you requested was not found. Please double-check both the city and the country or try with another"
         })
-    except InvalidAPIKey:
+    elif isinstance(e, InvalidAPIKey):
         log(LOG_ERROR, "The WAPI_API_KEY environment variable was set to an invalid value. \
 It needs to be a valid OpenWeather appid. If you don't have one, you can get one at: https://home.openweathermap.org/users/sign_up")
         status = INTERNAL_SERVER_ERROR 
-        content = json.dumps({
+        content = codec.dumps({
             "message": "Something went wrong with your request, please try again later"
         })
 
-    except Exception as e:
+    else:
         log(LOG_ERROR, "Unexpected exception raised when getting weather for {}, {}:\n{}".format(city, country, repr(e)))
         status = INTERNAL_SERVER_ERROR
-        content = json.dumps({
+        content = codec.dumps({
             "message": "Something went wrong with your request, please try again later"
         })
 
-    return Response(content, status, mimetype="application/json")
\ No newline at end of file
+    return status, content, headers
+
+# UNITTESTS
+
+class TestHandler(unittest.TestCase):
+    WEATHER_JSON = '{"location_name": "Montevideo, UY", "temperature": "88 \\u00b0F, 31 \\u00b0C", "forecast": []}'
+    KEY = ("montevideo", "uy")
+    URL = PATH + "?city=Montevideo&country=uy"
+
+    def setUp(self):
+        history = tempfile.TemporaryDirectory()
+        self.addCleanup(history.cleanup)
+        self.enterContext(patch.dict(os.environ, {'WAPI_API_KEY': "test", 'WAPI_HISTORY_DIR': history.name}))
+
+        self.client = WeatherClient()
+        # misses that get through the limiter would fail rather than reach the network
+        self.client.session = None
+        # saturated: its only slot is taken and nothing can wait for it
+        self.client.limiter = UpstreamLimiter(max_concurrency=1, max_queue=0, timeout=1)
+        self.client.limiter.acquire()
+        self.enterContext(patch.object(sys.modules[__name__], "weather_client", self.client))
+
+        app = Flask(__name__)
+        app.register_blueprint(weather_handler)
+        self.flask_client = app.test_client()
+
+    def test_rejected_miss(self):
+        response = self.flask_client.get(self.URL)
+        self.assertEqual(response.status_code, SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertNotIn("Warning", response.headers)
+        self.assertEqual(codec.loads(response.data), {"message": "The service is too busy right now, please try again later"})
+
+    def test_rejected_miss_serves_stale_weather(self):
+        self.client.cache.ttl = 0
+        self.client.cache.store(self.KEY, self.WEATHER_JSON)
+        response = self.flask_client.get(self.URL)
+        self.assertEqual(response.status_code, OK)
+        self.assertEqual(response.headers["Warning"], STALE_WARNING)
+        self.assertNotIn("Retry-After", response.headers)
+        self.assertEqual(response.get_data(as_text=True), self.WEATHER_JSON)
+
+    def test_hit_skips_saturated_limiter(self):
+        self.client.cache.store(self.KEY, self.WEATHER_JSON)
+        response = self.flask_client.get(self.URL)
+        self.assertEqual(response.status_code, OK)
+        self.assertNotIn("Warning", response.headers)
+        self.assertEqual(response.get_data(as_text=True), self.WEATHER_JSON)
+        self.assertEqual(self.client.limiter.active, 1)
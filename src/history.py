@@ -0,0 +1,297 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import fcntl
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+# fixed-width observation record:
+#   dt: observation unix time, as given by OpenWeather
+#   temp: kelvin
+#   wind_speed: m/s
+#   wind_deg: degrees
+#   pressure: hpa
+#   humidity: %
+#   weather_id: OpenWeather condition id of the cloudiness (8xx)
+# missing floats are stored as NaN, missing integers as MISSING
+RECORD = struct.Struct("<qdddiiI")
+DT = struct.Struct("<q")
+MISSING = -1
+
+DATA_FILE_EXTENSION = ".dat"
+LOCK_FILE_EXTENSION = ".lock"
+
+# files are compacted on append once their oldest record is this many seconds past retention, so that it's not done on every append
+COMPACTION_SLACK_SECONDS = 3600
+
+# descriptions of OpenWeather's cloudiness conditions, as the parser expects them in the "weather" list
+CLOUDINESS_DESCRIPTIONS = {
+    800: "clear sky",
+    801: "few clouds",
+    802: "scattered clouds",
+    803: "broken clouds",
+    804: "overcast clouds",
+}
+
+# class responsible for keeping every weather observation fetched from the external API on disk
+# each location has its own append-only file of fixed-width records sorted by observation time, e.g. {directory}/uy/montevideo.dat
+# so time range queries are a binary search over the memory-mapped file
+# appends and compactions of a location's file from every process and thread are serialized through a lock file next to it,
+# e.g {directory}/uy/montevideo.lock, so writers of different locations never wait on each other. Lock files are kept
+# even when their location's file is removed, as removing them while others wait on them would let two writers in at once
+# Attributes
+#   directory: path of the directory holding the files
+#   retention: number of seconds observations are kept for
+class HistoryStore:
+
+    def __init__(self, directory, retention):
+        self.directory = directory
+        self.retention = retention
+        os.makedirs(directory, exist_ok=True)
+
+    # appends an observation to the location's file, unless it's not newer than the last one stored
+    # (OpenWeather only updates observations every few minutes, so most fetches repeat the previous one)
+    # Parameters
+    #   key: tuple of the city in lowercase and the country code. E.g ("bogota", "co")
+    #   weather: dictionary with OpenWeather's OK response content for weather
+    # Output
+    #   True if the observation was stored
+    def append(self, key, weather):
+        record = pack_observation(weather)
+        if record is None:
+            return False
+        dt = DT.unpack_from(record)[0]
+
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.__locked(path):
+            with open(path, "a+b") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size % RECORD.size != 0:
+                    # dropping a record left half-written by a crash, so the next ones stay aligned
+                    size -= size % RECORD.size
+                    f.truncate(size)
+                if size > 0:
+                    f.seek(size - RECORD.size)
+                    if DT.unpack(f.read(DT.size))[0] >= dt:
+                        return False
+                    f.seek(0)
+                    first_dt = DT.unpack(f.read(DT.size))[0]
+                else:
+                    first_dt = dt
+                f.write(record)
+
+            if first_dt < self.__cutoff() - COMPACTION_SLACK_SECONDS:
+                self.__compact_file(path)
+        return True
+
+    # Parameters
+    #   key: tuple of the city in lowercase and the country code. E.g ("bogota", "co")
+    #   start, end: unix times, both inclusive
+    # Output
+    #   list of observation tuples (see RECORD) within the range, oldest first
+    def query(self, key, start, end):
+        try:
+            f = open(self.__path(key), "rb")
+        except FileNotFoundError:
+            return []
+
+        with f:
+            # ignoring a record still being written, if any
+            count = os.fstat(f.fileno()).st_size // RECORD.size
+            if count == 0:
+                return []
+            with mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ) as data:
+                first = find_first(data, count, start)
+                last = find_first(data, count, end + 1)
+                return [RECORD.unpack_from(data, i * RECORD.size) for i in range(first, last)]
+
+    # drops observations older than the retention period from every file
+    def compact(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(DATA_FILE_EXTENSION):
+                    path = os.path.join(root, name)
+                    with self.__locked(path):
+                        self.__compact_file(path)
+
+    # PRIVATE METHODS
+
+    def __path(self, key):
+        city, country = key
+        return os.path.join(self.directory, country, city + DATA_FILE_EXTENSION)
+
+    def __cutoff(self):
+        return int(time.time()) - self.retention
+
+    # holds the lock of the location whose file is at {path}
+    @contextmanager
+    def __locked(self, path):
+        with open(path[:-len(DATA_FILE_EXTENSION)] + LOCK_FILE_EXTENSION, "wb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # rewrites a file without the observations older than the retention period. Must be called holding its lock
+    # readers that already mapped the old file keep reading it until they're done
+    def __compact_file(self, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        count = len(data) // RECORD.size
+        first = find_first(data, count, self.__cutoff())
+        if first == 0:
+            return
+        if first == count:
+            os.remove(path)
+            return
+
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data[first * RECORD.size:count * RECORD.size])
+        os.replace(temp_path, path)
+
+# Parameters
+#   data: buffer of {count} records sorted by observation time
+#   dt: unix time
+# Output
+#   index of the first record observed at or after dt, {count} if there's none
+def find_first(data, count, dt):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if DT.unpack_from(data, middle * RECORD.size)[0] < dt:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+# packs the fields of an OpenWeather weather response that the parser uses into a record
+# Output
+#   the record's bytes, or None if the response has no observation time
+def pack_observation(weather):
+    if not isinstance(weather, dict) or "dt" not in weather:
+        return None
+    main = weather.get("main", {})
+    wind = weather.get("wind", {})
+    weather_id = 0
+    for item in weather.get("weather", []):
+        if item.get("id") in CLOUDINESS_DESCRIPTIONS:
+            weather_id = item["id"]
+            break
+    return RECORD.pack(
+        int(weather["dt"]),
+        main.get("temp", math.nan),
+        wind.get("speed", math.nan),
+        wind.get("deg", math.nan),
+        int(main.get("pressure", MISSING)),
+        int(main.get("humidity", MISSING)),
+        weather_id
+    )
+
+# turns an observation record back into an OpenWeather forecast-like item, so it can be parsed like one
+# Parameters
+#   observation: tuple unpacked from a record
+# Output
+#   dictionary with the fields present in the observation, plus a "dt_txt" with its UTC time. E.g "2021-10-28 00:00:00"
+def unpack_observation(observation):
+    dt, temp, wind_speed, wind_deg, pressure, humidity, weather_id = observation
+    weather = {
+        "dt": dt,
+        "dt_txt": datetime.fromtimestamp(dt, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "main": {},
+        "weather": [],
+    }
+    if not math.isnan(temp):
+        weather["main"]["temp"] = temp
+    if pressure != MISSING:
+        weather["main"]["pressure"] = pressure
+    if humidity != MISSING:
+        weather["main"]["humidity"] = humidity
+    if not math.isnan(wind_speed) and not math.isnan(wind_deg):
+        weather["wind"] = {"speed": wind_speed, "deg": wind_deg}
+    if weather_id in CLOUDINESS_DESCRIPTIONS:
+        weather["weather"].append({"id": weather_id, "description": CLOUDINESS_DESCRIPTIONS[weather_id]})
+    return weather
+
+# UNITTESTS
+
+class TestHistoryStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = HistoryStore(self.directory.name, retention=3600)
+        self.now = int(time.time())
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def observation(self, dt):
+        return {
+            "weather": [{"id": 500, "description": "light rain"}, {"id": 803, "description": "broken clouds"}],
+            "main": {"temp": 302.21, "pressure": 1020, "humidity": 32},
+            "wind": {"speed": 1.54, "deg": 180},
+            "dt": dt,
+        }
+
+    def test_pack_and_unpack(self):
+        weather = self.observation(1635369297)
+        observation = RECORD.unpack(pack_observation(weather))
+        expected_output = {
+            "dt": 1635369297,
+            "dt_txt": "2021-10-27 21:14:57",
+            "main": {"temp": 302.21, "pressure": 1020, "humidity": 32},
+            "wind": {"speed": 1.54, "deg": 180},
+            "weather": [{"id": 803, "description": "broken clouds"}],
+        }
+        self.assertEqual(unpack_observation(observation), expected_output)
+
+    def test_unpack_missing_fields(self):
+        observation = RECORD.unpack(pack_observation({"dt": 1635369297}))
+        self.assertEqual(unpack_observation(observation), {"dt": 1635369297, "dt_txt": "2021-10-27 21:14:57", "main": {}, "weather": []})
+
+    def test_query_range(self):
+        for dt in range(self.now - 50, self.now, 10):
+            self.store.append(("montevideo", "uy"), self.observation(dt))
+        result = self.store.query(("montevideo", "uy"), self.now - 40, self.now - 20)
+        self.assertEqual([observation[0] for observation in result], [self.now - 40, self.now - 30, self.now - 20])
+        self.assertEqual(self.store.query(("santiago", "cl"), self.now - 40, self.now), [])
+
+    def test_append_skips_repeated_observations(self):
+        self.assertTrue(self.store.append(("montevideo", "uy"), self.observation(self.now)))
+        self.assertFalse(self.store.append(("montevideo", "uy"), self.observation(self.now)))
+        self.assertFalse(self.store.append(("montevideo", "uy"), {"cod": 200}))
+        self.assertEqual(len(self.store.query(("montevideo", "uy"), 0, self.now)), 1)
+
+    def test_compact(self):
+        self.store.append(("montevideo", "uy"), self.observation(self.now - 7200))
+        self.store.append(("montevideo", "uy"), self.observation(self.now))
+        self.store.append(("santiago", "cl"), self.observation(self.now - 7200))
+        self.store.compact()
+        self.assertEqual(len(self.store.query(("montevideo", "uy"), 0, self.now)), 1)
+        self.assertEqual(self.store.query(("santiago", "cl"), 0, self.now), [])
+
+    def test_locks_are_per_location(self):
+        self.store.append(("montevideo", "uy"), self.observation(self.now - 10))
+        with open(os.path.join(self.directory.name, "uy", "montevideo" + LOCK_FILE_EXTENSION), "wb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            blocked = threading.Thread(target=self.store.append, args=(("montevideo", "uy"), self.observation(self.now)))
+            free = threading.Thread(target=self.store.append, args=(("salto", "uy"), self.observation(self.now)))
+            blocked.start()
+            free.start()
+            free.join(1)
+            blocked.join(0.1)
+            self.assertFalse(free.is_alive())
+            self.assertTrue(blocked.is_alive())
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        blocked.join(1)
+        self.assertEqual(len(self.store.query(("montevideo", "uy"), 0, self.now)), 2)
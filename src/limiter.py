@@ -0,0 +1,184 @@
+import asyncio
+import threading
+import math
+import time
+import unittest
+
+# weight of the last request when updating the average upstream latency
+LATENCY_SMOOTHING = 0.2
+
+# class responsible for bounding how many requests to the external API run at once
+# requests over the limit wait on a bounded queue, and are rejected right away when the queue is full or when, judging
+# by how long requests to the external API have been taking, they wouldn't get a slot before their deadline
+# Attributes
+#   max_concurrency: max number of requests to the external API running at once
+#   max_queue: max number of requests waiting for a slot
+#   timeout: max number of seconds a request waits for a slot
+#   active: number of requests currently holding a slot
+#   waiting: number of requests currently waiting for a slot
+#   latency: moving average of how many seconds a slot is held for
+class UpstreamLimiter:
+
+    def __init__(self, max_concurrency, max_queue, timeout):
+        if max_concurrency < 1:
+            raise ValueError("trying to initialize limiter with invalid max concurrency '{}'".format(max_concurrency))
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.latency = 0
+        self.lock = threading.Lock()
+        self.semaphore = threading.Semaphore(max_concurrency)
+
+    # takes a slot, waiting for one if necessary
+    # Output
+    #   the time at which the slot was taken, to be passed back to release
+    def acquire(self):
+        self._enqueue()
+        try:
+            acquired = self.semaphore.acquire(timeout=self.timeout)
+        finally:
+            self._dequeue()
+        if not acquired:
+            raise Rejected(self._retry_after())
+        return self._start()
+
+    def release(self, started):
+        self._finish(started)
+        self.semaphore.release()
+
+    # PROTECTED METHODS
+    # bookkeeping shared with the async limiter
+
+    # counts a request as waiting, rejecting it if it can't be admitted
+    def _enqueue(self):
+        with self.lock:
+            if self.active + self.waiting < self.max_concurrency:
+                self.waiting += 1
+                return
+            if self._queued() >= self.max_queue:
+                raise Rejected(self._retry_after())
+            if self._estimated_wait() > self.timeout:
+                raise Rejected(self._retry_after())
+            self.waiting += 1
+
+    def _dequeue(self):
+        with self.lock:
+            self.waiting -= 1
+
+    def _start(self):
+        with self.lock:
+            self.active += 1
+        return time.monotonic()
+
+    def _finish(self, started):
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.active -= 1
+            if self.latency == 0:
+                self.latency = elapsed
+            else:
+                self.latency = LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * self.latency
+
+    # number of requests that will have to wait for a slot to be released
+    def _queued(self):
+        return max(0, self.active + self.waiting - self.max_concurrency)
+
+    # seconds a new request would wait for a slot, assuming slots keep being held for as long as they have been
+    def _estimated_wait(self):
+        return (self._queued() + 1) / self.max_concurrency * self.latency
+
+    def _retry_after(self):
+        return max(1, math.ceil(self._estimated_wait()))
+
+# asyncio version of UpstreamLimiter, for the async client
+class AsyncUpstreamLimiter(UpstreamLimiter):
+
+    def __init__(self, max_concurrency, max_queue, timeout):
+        super().__init__(max_concurrency, max_queue, timeout)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def acquire(self):
+        self._enqueue()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise Rejected(self._retry_after())
+        finally:
+            self._dequeue()
+        return self._start()
+
+# EXCEPTIONS
+
+class Rejected(Exception):
+    def __init__(self, retry_after):
+        # seconds after which the request is likely to be admitted
+        self.retry_after = retry_after
+
+# UNITTESTS
+
+class TestUpstreamLimiter(unittest.TestCase):
+    def test_admits_up_to_max_concurrency(self):
+        limiter = UpstreamLimiter(max_concurrency=2, max_queue=0, timeout=1)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.active, 2)
+        self.assertRaises(Rejected, limiter.acquire)
+
+    def test_release_frees_slot(self):
+        limiter = UpstreamLimiter(max_concurrency=1, max_queue=0, timeout=1)
+        limiter.release(limiter.acquire())
+        limiter.acquire()
+        self.assertEqual(limiter.active, 1)
+
+    def test_queues_up_to_max_queue(self):
+        limiter = UpstreamLimiter(max_concurrency=1, max_queue=2, timeout=1)
+        started = limiter.acquire()
+        waiters = [threading.Thread(target=lambda: limiter.release(limiter.acquire())) for _ in range(2)]
+        for waiter in waiters:
+            waiter.start()
+        deadline = time.monotonic() + 1
+        while limiter.waiting < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(limiter._queued(), 2)
+        self.assertRaises(Rejected, limiter.acquire)
+
+        limiter.release(started)
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual((limiter.active, limiter.waiting), (0, 0))
+
+    def test_rejects_after_timeout(self):
+        limiter = UpstreamLimiter(max_concurrency=1, max_queue=1, timeout=0.01)
+        limiter.acquire()
+        self.assertRaises(Rejected, limiter.acquire)
+        self.assertEqual(limiter.waiting, 0)
+
+    def test_rejects_when_estimated_wait_exceeds_timeout(self):
+        limiter = UpstreamLimiter(max_concurrency=1, max_queue=10, timeout=1)
+        limiter.latency = 5
+        limiter.acquire()
+        started = time.monotonic()
+        with self.assertRaises(Rejected) as context:
+            limiter.acquire()
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(context.exception.retry_after, 5)
+
+    def test_waiting_request_gets_released_slot(self):
+        limiter = UpstreamLimiter(max_concurrency=1, max_queue=1, timeout=1)
+        started = limiter.acquire()
+        threading.Timer(0.05, limiter.release, (started,)).start()
+        limiter.acquire()
+        self.assertEqual(limiter.active, 1)
+
+    def test_async_limiter(self):
+        async def run():
+            limiter = AsyncUpstreamLimiter(max_concurrency=1, max_queue=1, timeout=1)
+            started = await limiter.acquire()
+            asyncio.get_running_loop().call_later(0.05, limiter.release, started)
+            await limiter.acquire()
+            limiter.max_queue = 0
+            with self.assertRaises(Rejected):
+                await limiter.acquire()
+        asyncio.run(run())